@@ -1,4 +1,3 @@
-import os
 from src.Configurator import Configurator
 
 
@@ -12,10 +11,10 @@ c.setupNews()
 c.setupWeather()
 c.setupWeatherYr()
 c.startApi(blocking=False)
+c.setupStateMachines()
 if c.calibrateEpaperOnStart:
     c.calibrateEpaper()
-c.setupStateMachines()
-if os.name == 'posix':
+if c.hasHardware:
     c.setupBtnLedControl()
     c.initStateMachines()
 c.waitApi()
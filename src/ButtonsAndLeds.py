@@ -1,4 +1,3 @@
-import os
 from src.CustomFormatter import CustomFormatter
 from events import Events
 from typing import Dict, Set
@@ -6,9 +5,7 @@ from datetime import datetime
 from time import sleep
 from concurrent.futures import ThreadPoolExecutor, Future
 import atexit
-
-if os.name == 'posix':
-    import RPi.GPIO as GPIO
+from src.hardware.Backend import GPIO
 
 
 class Button:
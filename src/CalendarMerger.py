@@ -3,8 +3,12 @@ import datetime
 import pytz
 import requests
 import jsons
+import numpy as np
 from os.path import exists
-from time import sleep
+from hashlib import sha256
+from threading import Semaphore
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
 from dateutil import tz
 from typing import Any, Callable, Union
 from src.CustomFormatter import CustomFormatter
@@ -12,10 +16,24 @@ from datetime import date, datetime, timedelta
 from icalendar import Calendar, Event, Todo
 from recurring_ical_events import of
 from src.SelfResetLazy import SelfResetLazy
+from src.IntervalTree import IntervalTree
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 
 
 
+retry_strategy = Retry(
+    total=3,
+    status_forcelist=[429, 500, 502, 503, 504],
+    backoff_factor=1)
+adapter = HTTPAdapter(max_retries=retry_strategy)
+# All calendars share this session, so that connections are pooled.
+http = requests.Session()
+http.mount("https://", adapter)
+http.mount("http://", adapter)
+
+
 def ifelse(cond, fnTrue: Callable[[], Any], iffalse):
     if cond:
         return fnTrue()
@@ -116,6 +134,45 @@ class DataEvent:
 
 
 
+class ParsedCalendar:
+    """
+    The VEVENTs and VTODOs of a parsed ical text. The version increases with
+    every parse, so that consumers can tell whether a calendar has changed.
+    The hashes tell whether its events or todos have changed, respectively.
+    """
+    def __init__(self, cal_text: str, version: int):
+        cal: Calendar = Calendar.from_ical(cal_text)
+        self.cal_text = cal_text
+        self.version = version
+        self.events: list[Event] = cal.walk('VEVENT')
+        self.todos: list[Todo] = cal.walk('VTODO')
+        self.events_hash = ParsedCalendar._hash(self.events)
+        self.todos_hash = ParsedCalendar._hash(self.todos)
+
+    @staticmethod
+    def _hash(components: Union[list[Event], list[Todo]]) -> str:
+        h = sha256()
+        for component in components:
+            h.update(component.to_ical())
+        return h.hexdigest()
+
+
+
+class MergedItems:
+    """
+    The filtered events and todos that a single calendar contributes to the
+    merged calendar. The events' version is that of the parsed calendar that
+    they were last changed in, which keys the materialized occurrences.
+    """
+    def __init__(self):
+        self.events: list[Event] = []
+        self.events_hash: str = None
+        self.events_version = 0
+        self.todos: list[Todo] = []
+        self.todos_hash: str = None
+
+
+
 class IntervalCalendar:
 
     def __init__(self, name: str, url: str, interval: int, data_folder: str, tz_indef: datetime.tzinfo=None):
@@ -127,44 +184,120 @@ class IntervalCalendar:
 
         self.logger = CustomFormatter.getLoggerFor(f'{self.__class__.__name__}({name})')
 
+        self._parsed: ParsedCalendar = None
+        self._parsed_version = 0
+        self._parsed_semaphore = Semaphore(1)
+
+        # Used for conditional requests and to detect unchanged calendars.
+        self._etag: str = None
+        self._last_modified: str = None
+        self._last_hash: str = None
+        self._last_text: str = None
+
         def getCalText():
             # Then we have to re-fetch this calendar.
             self.logger.debug(f'Downloading events for calendar "{self.name}".')
             ical_file = f'{self.data_folder}{os.sep}{self.name}.ical'
-            retries = 10
-            while retries > 0:
-                retries -= 1
-                try:
-                    res = requests.get(url=self.url, timeout=10)
-                    if res.status_code == 200:
-                        # Buffer this calendar to disk:
-                        with open(file=ical_file, mode='w', encoding='utf-8') as fp:
-                            print(res.text, file=fp)
-                        return res.text
-                    sleep(secs=3.0)
-                except Exception:
-                    pass # Explicitly ignore, as we have our retries.
-
-            self.logger.error(f'Cannot fetch ical for "{self.name}".')
+            headers = {}
+            if self._last_text is not None:
+                if self._etag is not None:
+                    headers['If-None-Match'] = self._etag
+                if self._last_modified is not None:
+                    headers['If-Modified-Since'] = self._last_modified
+
+            try:
+                res = http.get(url=self.url, timeout=10, headers=headers)
+                if res.status_code == 304 and self._last_text is not None:
+                    # Returning the very same text keeps the parsed calendar.
+                    self.logger.debug(f'Calendar "{self.name}" was not modified.')
+                    return self._last_text
+                if res.status_code != 200:
+                    raise Exception(f'Got status code {res.status_code}.')
+
+                self._etag = res.headers.get('ETag')
+                self._last_modified = res.headers.get('Last-Modified')
+                text = res.text
+                text_hash = sha256(text.encode('utf-8')).hexdigest()
+                if text_hash == self._last_hash and self._last_text is not None:
+                    self.logger.debug(f'Calendar "{self.name}" has not changed.')
+                    return self._last_text
+
+                # Buffer this calendar to disk:
+                with open(file=ical_file, mode='w', encoding='utf-8') as fp:
+                    print(text, file=fp)
+                self._last_hash = text_hash
+                self._last_text = text
+                return text
+            except Exception as e:
+                self.logger.error(f'Cannot fetch ical for "{self.name}": {str(e)}')
+                if self._last_text is not None:
+                    # Let the previous text be kept and marked as stale.
+                    raise e
 
             if exists(ical_file):
-                # Try to read previously buffered file:
+                # Cold start: Try to read previously buffered file:
                 with open(file=ical_file, mode='r', encoding='utf-8') as fp:
                     temp = fp.read()
                     self.logger.warn('Returning cached (potentially) old calendar.')
-                    return temp
+                self._last_hash = sha256(temp.encode('utf-8')).hexdigest()
+                self._last_text = temp
+                return temp
             else:
                 return '' # return empty text, so the others may work.
         
         def destroyCalText(cal: str):
-            self.logger.debug(f'Resetting calendar "{self.name}" now after a timeout of {format(self.interval, ".2f")} seconds.')
+            self.logger.debug(f'Discarding previous text of calendar "{self.name}" after a timeout of {format(self.interval, ".2f")} seconds.')
+            # Note that the parsed calendar is kept, as it is still valid if the
+            # next download tells us that the calendar has not changed.
 
         self.cal_text: SelfResetLazy[str] = SelfResetLazy(
-            fnCreateVal=getCalText, fnDestroyVal=destroyCalText, resetAfter=float(interval), resource_name=f'Cal:{self.name}')
+            fnCreateVal=getCalText, fnDestroyVal=destroyCalText, resetAfter=float(interval), resource_name=f'Cal:{self.name}', staleWhileRevalidate=True)
 
     @property
     def isCached(self):
         return self.cal_text.hasValue
+
+    @property
+    def isExpired(self) -> bool:
+        """
+        True if the text was never fetched, or is older than the interval. Stale
+        calendars are not considered expired, as they are retried by their timer.
+        """
+        age = self.cal_text.valueAge
+        return age is None or (age >= self.interval and not self.cal_text.isStale)
+
+    @property
+    def status(self) -> dict[str, Any]:
+        """
+        Whether the calendar's text could not be re-fetched and is therefore
+        older than its interval, and its age in seconds.
+        """
+        return {
+            'stale': self.cal_text.isStale,
+            'age': self.cal_text.valueAge,
+            'interval': self.interval,
+            'version': self._parsed_version
+        }
+
+    @property
+    def parsed(self) -> ParsedCalendar:
+        """
+        Returns the parsed calendar. The ical text is only parsed again after
+        it was re-fetched and has changed.
+        """
+        cal_text = self.cal_text.value
+        try:
+            self._parsed_semaphore.acquire()
+            parsed = self._parsed
+            if parsed is None or parsed.cal_text is not cal_text:
+                start = timer()
+                self._parsed_version += 1
+                parsed = ParsedCalendar(cal_text=cal_text, version=self._parsed_version)
+                self._parsed = parsed
+                self.logger.debug(f'Parsing calendar "{self.name}" (version {parsed.version}) took {format(timer() - start, ".2f")} seconds.')
+            return parsed
+        finally:
+            self._parsed_semaphore.release()
     
     @staticmethod
     def filterEvents(events: list[Event], cal_name: str=None, min_date: datetime=None):
@@ -197,9 +330,7 @@ class IntervalCalendar:
         return filtered
     
     def getEvents(self, min_date: datetime=None) -> list[Event]:
-        cal: Calendar = Calendar.from_ical(self.cal_text.value)
-
-        return IntervalCalendar.filterEvents(events=cal.walk('VEVENT'), cal_name=self.name, min_date=min_date)
+        return IntervalCalendar.filterEvents(events=self.parsed.events, cal_name=self.name, min_date=min_date)
     
     @staticmethod
     def filterTodos(todos: list[Todo], cal_name: str=None, min_date: datetime=None, include_indef: bool=True, include_undone: bool=True) -> list[Todo]:
@@ -243,9 +374,7 @@ class IntervalCalendar:
         return filtered
     
     def getTodos(self, min_date: datetime=None, include_indef: bool=True, include_undone: bool=True) -> list[Todo]:
-        cal: Calendar = Calendar.from_ical(self.cal_text.value)
-
-        return IntervalCalendar.filterTodos(todos=cal.walk('VTODO'), cal_name=self.name, min_date=min_date, include_indef=include_indef, include_undone=include_undone)
+        return IntervalCalendar.filterTodos(todos=self.parsed.todos, cal_name=self.name, min_date=min_date, include_indef=include_indef, include_undone=include_undone)
 
 
 
@@ -276,6 +405,55 @@ class Weekday:
 
 
 
+class OccurrenceStore:
+    """
+    Holds all occurrences of the merged events within a horizon. Their starts
+    and ends are stored as UTC epochs in parallel arrays that are sorted by
+    start, and that index into a table of DataEvents. This way, lookups are
+    binary searches rather than comparisons of timezone-aware datetimes.
+    """
+    def __init__(self, events: list[DataEvent], horizon_start: datetime, horizon_stop: datetime, key: Any=None):
+        self.key = key
+        self.horizon_start = horizon_start
+        self.horizon_stop = horizon_stop
+        # All-day and floating events are interpreted in the horizon's timezone.
+        self.tzinfo = horizon_start.tzinfo
+        self.events = events
+
+        starts = np.fromiter((self.epoch(evt.start) for evt in events), dtype=np.float64, count=len(events))
+        ends = np.fromiter((self.epoch(evt.end) for evt in events), dtype=np.float64, count=len(events))
+        self.index = np.argsort(starts, kind='stable')
+        self.starts = starts[self.index]
+        self.ends = ends[self.index]
+        self._tree = IntervalTree(starts=self.starts, ends=self.ends)
+
+    def epoch(self, dt) -> float:
+        dt = to_datetime(dt)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=self.tzinfo)
+        return dt.timestamp()
+
+    def covers(self, start, stop) -> bool:
+        return self.epoch(self.horizon_start) <= self.epoch(start) and self.epoch(stop) <= self.epoch(self.horizon_stop)
+
+    def overlapping(self, start, stop) -> list[DataEvent]:
+        """
+        Returns the events overlapping with [start, stop), sorted by start. Uses
+        the same rules as between() of recurring_ical_events, i.e., an event
+        without duration is included if it starts within the span.
+        """
+        span_start, span_stop = self.epoch(start), self.epoch(stop)
+        # These are the events that started before and are still ongoing,
+        # followed by those that start within the span.
+        idx = np.concatenate((
+            np.sort(self._tree.containing(point=span_start)),
+            np.arange(
+                np.searchsorted(self.starts, span_start, side='left'),
+                np.searchsorted(self.starts, span_stop, side='left'))))
+        return [self.events[i] for i in self.index[idx]]
+
+
+
 class CalendarMerger:
 
     def __init__(self, data_folder: str, cal_config=None):
@@ -288,32 +466,80 @@ class CalendarMerger:
         self.include_indefinite = cal_config['tasks']['include_indefinite']
         self.include_overdue_undone = cal_config['tasks']['include_overdue_undone']
 
-        def merge_calendars(events: bool=True) -> Union[list[Event], list[Todo]]:
-            items: list[DataEvent] = []
-            for cal in self.calendars.values():
-                if events:
-                    items += cal.getEvents()
-                else:
-                    items += cal.getTodos(include_indef=self.include_indefinite, include_undone=self.include_overdue_undone)
-            return items
+        # All occurrences within this horizon around today are materialized once.
+        horizon = cal_config.get('horizon', {})
+        self.horizon_weeks_before = float(horizon.get('weeks_before', 2))
+        self.horizon_weeks_after = float(horizon.get('weeks_after', 8))
+        self._occurrences: OccurrenceStore = None
+        self._occurrences_semaphore = Semaphore(1)
 
+        # Used to download and parse expired calendars concurrently.
+        self._tpe = ThreadPoolExecutor(max_workers=int(cal_config.get('refresh_workers', 4)))
 
-        self._merged_evts: SelfResetLazy[list[Event]] = SelfResetLazy(resource_name='merged_events', fnCreateVal=lambda: merge_calendars(events=True), resetAfter=None)
-        self._merged_todos: SelfResetLazy[list[Todo]] = SelfResetLazy(resource_name='merged_todos', fnCreateVal=lambda: merge_calendars(events=False), resetAfter=None)
+        # The contributions of each calendar to the merged calendar. Only those
+        # of calendars that have changed are re-computed.
+        self._merged: dict[str, MergedItems] = {}
+        self._merged_semaphore = Semaphore(1)
     
     def addCalendar(self, intervalCal: IntervalCalendar):
         self.logger.debug(f'Adding IntervalCalendar "{intervalCal.name}"')
         self.calendars[intervalCal.name] = intervalCal
         return self
 
+    def _refreshCalendars(self) -> tuple[int]:
+        """
+        Makes sure that all calendars are available and current, by concurrently
+        fetching and parsing those that were never fetched, or whose text has
+        expired (see IntervalCalendar.isExpired). Returns the calendars'
+        versions.
+        """
+        def refresh(cal: IntervalCalendar) -> int:
+            start = timer()
+            if cal.isCached:
+                cal.cal_text.revalidate()
+            version = cal.parsed.version
+            self.logger.debug(f'Refreshing calendar "{cal.name}" took {format(timer() - start, ".2f")} seconds.')
+            return version
+
+        expired = [cal for cal in self.calendars.values() if cal.isExpired]
+        if len(expired) > 0:
+            start = timer()
+            for future in [self._tpe.submit(refresh, cal) for cal in expired]:
+                future.result() # re-throws, if any
+            self.logger.debug(f'Refreshing {len(expired)} calendar(s) took {format(timer() - start, ".2f")} seconds.')
+
+        return tuple(cal.parsed.version for cal in self.calendars.values())
+
+    def _getMergedSources(self) -> dict[str, MergedItems]:
+        self._refreshCalendars()
+
+        try:
+            self._merged_semaphore.acquire()
+            for name, cal in self.calendars.items():
+                parsed = cal.parsed
+                items = self._merged.get(name)
+                if items is None:
+                    items = self._merged[name] = MergedItems()
+
+                if items.events_hash != parsed.events_hash:
+                    self.logger.debug(f'Merging events of calendar "{name}" (version {parsed.version}).')
+                    items.events = IntervalCalendar.filterEvents(events=parsed.events, cal_name=name)
+                    items.events_hash = parsed.events_hash
+                    items.events_version = parsed.version
+                if items.todos_hash != parsed.todos_hash:
+                    self.logger.debug(f'Merging todos of calendar "{name}" (version {parsed.version}).')
+                    items.todos = IntervalCalendar.filterTodos(todos=parsed.todos, cal_name=name, include_indef=self.include_indefinite, include_undone=self.include_overdue_undone)
+                    items.todos_hash = parsed.todos_hash
+
+            return dict((name, self._merged[name]) for name in self.calendars.keys())
+        finally:
+            self._merged_semaphore.release()
+
     def _getMergedItems(self, events: bool=True) -> Union[list[Event], list[Todo]]:
-        if not all([cal.isCached for cal in self.calendars.values()]):
-            self._merged_evts.unsetValue()
-            self._merged_todos.unsetValue()
-        
-        if events:
-            return self._merged_evts.value
-        return self._merged_todos.value
+        merged: Union[list[Event], list[Todo]] = []
+        for items in self._getMergedSources().values():
+            merged += items.events if events else items.todos
+        return merged
 
     def getMergedCalendar(self, events: bool=True, min_date: datetime=None) -> Calendar:
         c = Calendar()
@@ -331,10 +557,14 @@ class CalendarMerger:
         
         return c
 
-    def todosBetween(self, start, stop, include_indefinite=True, include_overdue_undone=True) -> list[DataEvent]:
+    def _todoItems(self, min_date: datetime=None) -> list[DataEvent]:
+        """
+        Returns all merged and not yet completed todos as DataEvents. Naive
+        starts and ends are localized using the todo's calendar's timezone.
+        """
         todos = []
 
-        for item in self.getMergedCalendar(events=False, min_date=start).subcomponents:
+        for item in self.getMergedCalendar(events=False, min_date=min_date).subcomponents:
             todo = DataEvent.fromVtodo(item)
             if todo.is_complete:
                 continue
@@ -345,37 +575,84 @@ class CalendarMerger:
             # Sometimes, they don't have an end date either,
             # which makes them indefinite.
             indef_tz = pytz.timezone(cal.tz_indef)
-            has_start = type(todo.start) is datetime
-            if has_start and todo.start.tzinfo is None:
+            if type(todo.start) is datetime and todo.start.tzinfo is None:
                 todo.start = indef_tz.localize(todo.start)
-            has_end = type(todo.end) is datetime
-            if has_end and todo.end.tzinfo is None:
+            if type(todo.end) is datetime and todo.end.tzinfo is None:
                 todo.end = indef_tz.localize(todo.end)
-            
-            point: datetime = todo.end if has_end else todo.start
 
-            is_indef = (not has_start) and (not has_end)
-            is_overdue_undone = type(point) is datetime and not todo.is_complete and compare_datetime(point, start) == -1
+            todos.append(todo)
 
-            if is_indef:
-                if include_indefinite:
-                    todos.append(todo)
-            elif is_overdue_undone:
-                if include_overdue_undone:
-                    todos.append(todo)
-            else:
-                if has_start ^ has_end:
-                    if point >= start and point <= stop:
-                        todos.append(todo)
-                elif todo.start >= start and todo.end <= stop:
-                    todos.append(todo)
-        
         return todos
 
-    def eventsBetween(self, start, stop) -> list[DataEvent]:
-        return list(map(
+    @staticmethod
+    def _todoIsBetween(todo: DataEvent, start, stop, include_indefinite=True, include_overdue_undone=True) -> bool:
+        has_start = type(todo.start) is datetime
+        has_end = type(todo.end) is datetime
+        point: datetime = todo.end if has_end else todo.start
+
+        is_indef = (not has_start) and (not has_end)
+        is_overdue_undone = type(point) is datetime and not todo.is_complete and point < start
+
+        if is_indef:
+            return include_indefinite
+        elif is_overdue_undone:
+            return include_overdue_undone
+        elif has_start ^ has_end:
+            return point >= start and point <= stop
+        return todo.start >= start and todo.end <= stop
+
+    def todosBetween(self, start, stop, include_indefinite=True, include_overdue_undone=True) -> list[DataEvent]:
+        return list(filter(
+            lambda todo: CalendarMerger._todoIsBetween(todo=todo, start=start, stop=stop, include_indefinite=include_indefinite, include_overdue_undone=include_overdue_undone),
+            self._todoItems(min_date=start)))
+
+    def _expandEvents(self, start, stop, key: Any=None) -> OccurrenceStore:
+        events = list(map(
             lambda vevt: DataEvent.fromVevent(vevt),
             of(self.getMergedCalendar(events=True, min_date=start)).between(start, stop)))
+        return OccurrenceStore(events=events, horizon_start=start, horizon_stop=stop, key=key)
+
+    @property
+    def occurrences(self) -> OccurrenceStore:
+        """
+        Returns the materialized occurrences within the configured horizon.
+        These are only expanded again if the events of any calendar changed,
+        or if the horizon moved with the current day.
+        """
+        this_tz = datetime.now().astimezone().tzinfo
+        today = datetime.now(tz=this_tz).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Only changed events require to materialize the occurrences again.
+        key = (today, tuple((name, items.events_version) for name, items in self._getMergedSources().items()))
+
+        try:
+            self._occurrences_semaphore.acquire()
+            if self._occurrences is None or self._occurrences.key != key:
+                start = timer()
+                self._occurrences = self._expandEvents(
+                    start=today - timedelta(weeks=self.horizon_weeks_before),
+                    stop=today + timedelta(weeks=self.horizon_weeks_after) - timedelta(microseconds=1),
+                    key=key)
+                self.logger.debug(f'Materializing {len(self._occurrences.events)} occurrences took {format(timer() - start, ".2f")} seconds.')
+            return self._occurrences
+        finally:
+            self._occurrences_semaphore.release()
+
+    def _occurrencesBetween(self, start, stop) -> OccurrenceStore:
+        store = self.occurrences
+        if store.covers(start=start, stop=stop):
+            return store
+        self.logger.debug(f'The span from {start} to {stop} is outside the horizon, expanding it separately.')
+        return self._expandEvents(start=start, stop=stop)
+
+    def overlapping(self, start, stop) -> list[DataEvent]:
+        """
+        Returns all event occurrences that overlap with the span from start to
+        stop (exclusive).
+        """
+        return self._occurrencesBetween(start=start, stop=stop).overlapping(start=start, stop=stop)
+
+    def eventsBetween(self, start, stop) -> list[DataEvent]:
+        return self.overlapping(start=start, stop=stop)
     
     def itemsToday(self, events=True, add_days=0) -> list[DataEvent]:
         """
@@ -412,25 +689,44 @@ class CalendarMerger:
         if not start_dt is None:
             begin = start_dt.replace(tzinfo=this_tz, hour=0, minute=0, second=0, microsecond=0)
 
-        weekdays = []
+        weekdays: list[Weekday] = []
+        day_starts: list[datetime] = []
+        day_stops: list[datetime] = []
 
         while begin.isoweekday() > 1:
             # today is NOT monday, let's go back and find the dates before
             begin = begin - timedelta(days=1)
-        
+
         for _ in range(int(num_weeks * 7)):
             wd = Weekday(month=begin.month, week=begin.isocalendar().week, day=begin.day, weekday=begin.isoweekday(), before_today=compare_datetime(begin, today) == -1, is_today=begin.month == today.month and begin.day == today.day)
 
-            wd.addEvents(self.eventsBetween(
-                start=begin, stop=begin + timedelta(days=1) - timedelta(microseconds=1)))
-            wd.addEvents(self.todosBetween(
-                include_indefinite=False, # Here we need concrete todos!
-                start=begin, stop=begin + timedelta(days=1) - timedelta(microseconds=1)))
-
             weekdays.append(wd)
-            
+            day_starts.append(begin)
+            day_stops.append(begin + timedelta(days=1) - timedelta(microseconds=1))
+
             begin = begin + timedelta(days=1)
-        
+
+        if len(weekdays) == 0:
+            return weekdays
+
+        # The (recurring) events of the entire range are expanded at most once,
+        # then each day is looked up in the materialized occurrences.
+        store = self._occurrencesBetween(start=day_starts[0], stop=day_stops[-1])
+        for wd, day_start, day_stop in zip(weekdays, day_starts, day_stops):
+            wd.addEvents(store.overlapping(start=day_start, stop=day_stop))
+
+        # Todos are not expanded, so we fetch them once and check each against
+        # every day. Overdue todos show up on every day after they were due,
+        # unless they are not supposed to be included at all.
+        todos = self._todoItems(min_date=day_starts[0])
+        for wd, day_start, day_stop in zip(weekdays, day_starts, day_stops):
+            wd.addEvents(filter(
+                lambda todo: CalendarMerger._todoIsBetween(
+                    todo=todo, start=day_start, stop=day_stop,
+                    include_indefinite=False, # Here we need concrete todos!
+                    include_overdue_undone=self.include_overdue_undone),
+                todos))
+
         return weekdays
 
     def __str__(self):
@@ -452,4 +748,11 @@ class CalendarMerger:
     def apiCal(self):
         return self.__str__(), 200, {'Content-Type': 'text/calendar; charset=utf-8'}
 
+    def apiStatus(self):
+        status = dict((name, cal.status) for name, cal in self.calendars.items())
+        for name, st in status.items():
+            if st['stale']:
+                self.logger.warning(f'Calendar "{name}" is stale, its age is {format(st["age"], ".2f")} seconds.')
+        return status
+
 
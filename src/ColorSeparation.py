@@ -0,0 +1,66 @@
+import numpy as np
+from PIL import Image
+
+
+
+def separatePlanes(img: Image.Image) -> tuple[Image.Image, Image.Image]:
+    """
+    Splits an image into the planes for the black and the red pixels of the
+    e-paper, which are returned in this order. Pixels whose red channel is not
+    larger than both green and blue are removed from the red plane (made
+    white). Pixels whose red channel is larger than both are removed from the
+    black plane. All other pixels remain in both planes.
+    """
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+
+    pixels = np.asarray(img)
+    r, g, b = pixels[:, :, 0], pixels[:, :, 1], pixels[:, :, 2]
+    not_red = (r <= g) & (r <= b)
+    red = (r > g) & (r > b)
+
+    redimg = pixels.copy()
+    redimg[not_red] = 255
+    blackimg = pixels.copy()
+    blackimg[red] = 255
+
+    return Image.fromarray(blackimg, mode=img.mode), Image.fromarray(redimg, mode=img.mode)
+
+
+def _separatePlanesLoop(img: Image.Image) -> tuple[Image.Image, Image.Image]:
+    """
+    The previous, pixel-by-pixel implementation of separatePlanes(). Only kept
+    as reference for the benchmark below.
+    """
+    redimg = img.copy()
+    rpixels = redimg.load()
+    blackimg = img.copy()
+    bpixels = blackimg.load()
+
+    for i in range(redimg.size[0]):
+        for j in range(redimg.size[1]):
+            if rpixels[i, j][0] <= rpixels[i, j][1] and rpixels[i, j][0] <= rpixels[i, j][2]:
+                rpixels[i, j] = (255, 255, 255)
+            elif bpixels[i, j][0] > bpixels[i, j][1] and bpixels[i, j][0] > bpixels[i, j][2]:
+                bpixels[i, j] = (255, 255, 255)
+
+    return blackimg, redimg
+
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+
+    rng = np.random.default_rng(seed=1)
+    for mode in ['RGB', 'RGBA']:
+        img = Image.fromarray(rng.integers(0, 256, size=(480, 800, len(mode)), dtype=np.uint8), mode=mode)
+
+        start = timer()
+        loop_black, loop_red = _separatePlanesLoop(img)
+        loop_time = timer() - start
+
+        start = timer()
+        black, red = separatePlanes(img)
+        vec_time = timer() - start
+
+        same = loop_black.tobytes() == black.tobytes() and loop_red.tobytes() == red.tobytes()
+        print(f'{mode}: loop took {format(loop_time, ".3f")}s, vectorized took {format(vec_time, ".3f")}s ({format(loop_time / vec_time, ".0f")}x), identical: {same}')
@@ -8,30 +8,33 @@ import atexit
 import locale
 import subprocess
 import requests
-from fasteners import InterProcessLock
 from base64 import b64decode
 from PIL import Image
 from io import BytesIO
-from typing import Dict, Type, TypeVar, ClassVar
+from typing import Any, Callable, Dict, Type, TypeVar, ClassVar
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from json import dumps, load
 from jsons import loads
+from time import monotonic
 from timeit import default_timer as timer
 from src.CustomFormatter import CustomFormatter
 from src.CalendarMerger import CalendarMerger
 from src.ButtonsAndLeds import ButtonsAndLeds, Button, Led
-from src.Api import Api
+from src.Api import Api, MyJSONEncoder
 from src.WeatherImpl import WeatherImpl
-from src.ePaper import ePaper
 from src.state.StateManager import StateManager
 from src.state.DisplayStateMachines import ePaperStateMachine, TextLcdStateMachine
 from src.ScreenshotMaker import ScreenshotMaker
-from src.SelfResetLazy import SelfResetLazy, AtomicResource
+from src.ColorSeparation import separatePlanes
+from src.ScreenPlanes import ScreenPlanes
+from src.SelfResetLazy import ResourcePool
 from src.NewsImpl import NewsImpl
 from importlib import import_module
 from os.path import join, abspath
-from threading import Timer
+from src.Scheduler import scheduler
+from src.hardware import Backend
+from src.hardware.Backend import GPIO
 from flask import render_template
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
@@ -42,11 +45,6 @@ from src.weather.MyWeatherImpl import FORECAST_TYPE, MyWeatherImpl
 
 T = TypeVar('T')
 
-if os.name == 'posix':
-    import RPi.GPIO as GPIO
-    from src.ButtonsAndLeds import ButtonsAndLeds, Button, Led
-    atexit.register(lambda: GPIO.cleanup())
-
 
 
 
@@ -73,17 +71,21 @@ class Configurator:
 
     def __init__(self, config):
         self.config = config
-        if os.name == 'posix' and not Configurator.GPIO_SET_UP:
+        self.data_folder = config['general']['data_folder'][os.name]
+        pathlib.Path(self.data_folder).mkdir(parents=True, exist_ok=True)
+
+        # The hardware is either the actual Raspberry Pi, simulated, or none.
+        Backend.configure(conf=config['general'].get('hardware', {}), data_folder=self.data_folder)
+        if Backend.available() and not Configurator.GPIO_SET_UP:
             GPIO.setmode(GPIO.BCM) # We do this once application-wide
             GPIO.setwarnings(True) # Should never be hidden, that'd be stupid
+            atexit.register(lambda: GPIO.cleanup())
             Configurator.GPIO_SET_UP = True
 
         # For async firing of callbacks etc.
         self._tpe = ThreadPoolExecutor(max_workers=2)
         atexit.register(lambda: self._tpe.shutdown())
 
-        self.data_folder = config['general']['data_folder'][os.name]
-        pathlib.Path(self.data_folder).mkdir(parents=True, exist_ok=True)
         CustomFormatter.setLevel(level=getattr(logging, config['general']['log_level'], None))
         CustomFormatter.setLogFile(
             file=abspath(join(self.data_folder, config['general']['log_file'])),
@@ -102,16 +104,37 @@ class Configurator:
         self.hasTextLcd: bool = False
         self.textLcdStateMachine: TextLcdStateMachine = None
         self.ctrl: ButtonsAndLeds = None
-        self.res_ssm: SelfResetLazy[AtomicResource[ScreenshotMaker]] = None
+        self.res_ssm: ResourcePool[ScreenshotMaker] = None
+        # The data of each view that can be updated in place (by route).
+        self._views: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        # Seconds it took each screen (by name) to be ready, when last rendered.
+        self._time_to_ready: Dict[str, float] = {}
+        # When the next screenshot of each screen with an interval is due (by
+        # its URL, in terms of time.monotonic()).
+        self._screen_due: Dict[str, float] = {}
+        self._prewarm_before: float = None
 
         self._svc_container: Dict[Type, T] = {}
         self.api.addStaticServe(static_path='data', directory=self.data_folder)
+        if not Backend.simulation() is None:
+            # Allows to measure what was sent to the simulated hardware.
+            self.api.addRoute(route='/hardware/simulation', fn=lambda: Backend.simulation().stats)
     
     def getService(self, klass: Type[T]) -> T:
         if klass in self._svc_container.keys():
             return self._svc_container[klass]
         raise Exception(f'No service previously registered for type "{klass.__name__}".')
 
+    def _addView(self, route: str, template: str, fnData: Callable[[], Dict[str, Any]]):
+        """
+        Adds a route that renders the template with the variables returned by
+        fnData(). Open pages of the view can also be updated in place with the
+        same variables (see setupScreenshotService()).
+        """
+        self._views[route] = fnData
+        self.api.addRoute(route=route, fn=lambda: render_template(template, **fnData()))
+        return self
+
 
     @staticmethod
     def instance() -> Configurator:
@@ -270,6 +293,7 @@ class Configurator:
 
         # Add calendar-related routes:
         self.api.addRoute(route='/calendar/ical', fn=self.calendar.apiCal)
+        self.api.addRoute(route='/calendar/status', fn=self.calendar.apiStatus)
 
         def render3way1day():
             c = self.config['views']['3-way-1-day']['calendar']
@@ -287,19 +311,17 @@ class Configurator:
                 # We'll have to subtract some time; supported format is 'n_weeks', so we'll look for 'n'
                 start_dt = start_dt - timedelta(weeks=int(start_split[1].split('_')[0]))
 
-            return render_template(
-                'calendar/3-way-1-day.html',
+            return dict(
                 time_now=datetime.now().astimezone(),
                 events_of_the_day=self.calendar.eventsToday() + self.calendar.todosToday(),
                 weekday_events=self.calendar.weekdayItems(num_weeks=num_weeks, start_dt=start_dt),
                 day_names=list(map(lambda str: str.capitalize(), calendar.day_name)),
                 view_config=self.config['views']['3-way-1-day'])
         
-        self.api.addRoute(route='/calendar/3-way-1-day', fn=render3way1day)
+        self._addView(route='/calendar/3-way-1-day', template='calendar/3-way-1-day.html', fnData=render3way1day)
 
         def render2way2days():
-            return render_template(
-                'calendar/2-way-2-days.html',
+            return dict(
                 time_tomorrow=datetime.now().astimezone() + timedelta(days=1),
                 time_overmorrow=datetime.now().astimezone() + timedelta(days=2),
                 day_names=list(map(lambda str: str.capitalize(), calendar.day_name)),
@@ -308,7 +330,7 @@ class Configurator:
                 events_overmorrow=self.calendar.eventsToday(add_days=2) + self.calendar.todosToday(add_days=2),
                 view_config=self.config['views']['2-way-2-days'])
 
-        self.api.addRoute(route='/calendar/2-way-2-days', fn=render2way2days)
+        self._addView(route='/calendar/2-way-2-days', template='calendar/2-way-2-days.html', fnData=render2way2days)
 
         def renderMultiWeek():
             c = self.config['views']['multi-week']
@@ -326,14 +348,13 @@ class Configurator:
                 # We'll have to subtract some time; supported format is 'n_weeks', so we'll look for 'n'
                 start_dt = start_dt - timedelta(weeks=int(start_split[1].split('_')[0]))
             
-            return render_template(
-                'calendar/multi-week.html',
+            return dict(
                 time_now=datetime.now().astimezone(),
                 weekday_events=self.calendar.weekdayItems(num_weeks=num_weeks, start_dt=start_dt),
                 day_names=list(calendar.day_name),
                 view_config=self.config['views']['multi-week'])
         
-        self.api.addRoute(route='/calendar/multi-week', fn=renderMultiWeek)
+        self._addView(route='/calendar/multi-week', template='calendar/multi-week.html', fnData=renderMultiWeek)
 
         self.logger.debug('Added calendar-related routes.')
 
@@ -377,22 +398,9 @@ class Configurator:
             self.logger.debug('Processing user-cropped image.')
             # png is "data:image/png;base64,<the base64-encoded image>"
             img = Image.open(BytesIO(b64decode(s=png.split(',')[1]))).resize(size=(800, 480), resample=Image.LANCZOS)
-            redimg = img.copy()
-            rpixels = redimg.load()
-            blackimg = img
-            bpixels = blackimg.load()
-
-            for i in range(redimg.size[0]):
-                for j in range(redimg.size[1]):
-                    if rpixels[i, j][0] <= rpixels[i, j][1] and rpixels[i, j][0] <= rpixels[i, j][2]:
-                        rpixels[i, j] = (255, 255, 255)
-                    elif bpixels[i, j][0] > bpixels[i, j][1] and bpixels[i, j][0] > bpixels[i, j][2]:
-                        bpixels[i, j] = (255, 255, 255)
+            blackimg, redimg = separatePlanes(img)
             
-            with open(file=abspath(join(self.data_folder, f'screenshot_b.png')), mode='wb') as fp:
-                blackimg.save(fp)
-            with open(file=abspath(join(self.data_folder, f'screenshot_r.png')), mode='wb') as fp:
-                redimg.save(fp)
+            self.getScreenPlanes().write(name='screenshot', black_img=blackimg, red_img=redimg)
             
             self._tpe.submit(lambda: self.epaperStateMachine.activate(transition='show-userscreen', duration=3600))
 
@@ -487,27 +495,30 @@ class Configurator:
         self._svc_container[NewsImpl] = user_impl
 
         def renderHeadlines():
-            return render_template(
-                'news/headlines.html',
+            return dict(
                 time_now=datetime.now().astimezone(),
                 news_items=user_impl.items,
                 view_config=self.config['views']['headlines'])
 
-        self.api.addRoute(route='/news/headlines', fn=renderHeadlines)
+        self._addView(route='/news/headlines', template='news/headlines.html', fnData=renderHeadlines)
 
         self.logger.debug('Added news-related routes.')
 
         return self
 
+    @property
+    def hasHardware(self) -> bool:
+        return Backend.available()
+
     @property
     def calibrateEpaperOnStart(self) -> bool:
         return self.config['general']['calibrate_epaper_on_start']
     
     def calibrateEpaper(self):
-        e = ePaper()
+        # Uses the state machine's session, which owns the e-paper.
         start = timer()
         self.logger.info('Starting e-paper calibration.')
-        e.calibrate()
+        self.epaperStateMachine.calibrate()
         self.logger.info(f'Finished e-paper calibration after {format(timer() - start, ".2f")} seconds.')
         return self
     
@@ -516,40 +527,90 @@ class Configurator:
         return self.config['general']['use_screenshot_service']
     
     def setupScreenshotService(self):
-        self.logger.info('Setting up a ScreenshotMaker for internal API.')
-        destroy_after = self.config['general']['destroy_screenshot_service_after']
-
-        def create_ssm() -> AtomicResource[ScreenshotMaker]:
-            start = timer()
-            self.logger.debug(f'Creating a ScreenshotMaker, it shall live for {format(destroy_after, ".2f")} seconds.')
-            ssm = ScreenshotMaker(driver=self.config['general']['screen_driver'])
-            self.logger.debug(f'Done creating a ScreenshotMaker, it took {format(timer() - start, ".2f")} seconds.')
-            return AtomicResource(item=ssm, resource_name='SSM')
+        """
+        Sets up a pool of ScreenshotMakers, such that independent screens can
+        be rendered in parallel. The optional general 'screenshot_pool' config
+        sets the number of browsers ('size'), how long to wait for one of them
+        ('acquire_timeout'), and after how many seconds an unused browser is
+        destroyed ('idle_after', defaults to 'destroy_screenshot_service_after').
+
+        Browsers are not destroyed if a screenshot is due within 'warm_window'
+        seconds, and they are started 'prewarm_before' seconds before the next
+        screenshot is due (see setupScreenIntervals()), such that scheduled
+        screenshots do not have to wait for the browser to start.
+
+        Browsers grow with every page they load. After each screenshot, the
+        browser is recycled if its processes use more than 'max_rss_mb' MB, or
+        after 'max_renders' screenshots. Both are unlimited by default. The
+        pool's and the browsers' numbers, and how long each screen took to be
+        ready, are served at /screenshot-service.
+
+        With 'live_pages', each browser keeps the pages of views that support
+        it open, and later screenshots push the view's fresh data into them,
+        instead of loading the page again.
+        """
+        pool = self.config['general'].get('screenshot_pool', {})
+        size = int(pool.get('size', 1))
+        idle_after = float(pool.get('idle_after', self.config['general']['destroy_screenshot_service_after']))
+        acquire_timeout = pool.get('acquire_timeout', None)
+        warm_window = float(pool.get('warm_window', 120.0))
+        self._prewarm_before = float(pool.get('prewarm_before', 30.0))
+        max_rss_mb = pool.get('max_rss_mb', None)
+        max_renders = pool.get('max_renders', None)
+        live_pages = bool(pool.get('live_pages', False))
+        self.logger.info(f'Setting up a pool of up to {size} ScreenshotMaker(s) for internal API.')
+
+        def create_ssm() -> ScreenshotMaker:
+            self.logger.debug(f'Creating a ScreenshotMaker, it shall live until it was unused for {format(idle_after, ".2f")} seconds.')
+            return ScreenshotMaker(driver=self.config['general']['screen_driver'])
         
-        self.res_ssm = SelfResetLazy(resource_name='SSM', fnCreateVal=create_ssm, fnDestroyVal=lambda ssm_atom: ssm_atom.obtain().__del__(), resetAfter=float(destroy_after))
+        self.res_ssm = ResourcePool(resource_name='SSM', fnCreate=create_ssm, fnDestroy=lambda ssm: ssm.__del__(), fnHealthy=lambda ssm: ssm.isHealthy(),
+            fnWarm=lambda: self._numScreensDue(within=warm_window), capacity=size, timeout=None if acquire_timeout is None else float(acquire_timeout), idleAfter=idle_after)
+        atexit.register(self.res_ssm.clear)
+
+        def must_recycle(ssm: ScreenshotMaker) -> bool:
+            if not ssm.lastRss is None:
+                self.logger.debug(f'The ScreenshotMaker uses {format(ssm.lastRss / 1024**2, ".1f")} MB after {ssm.numRenders} screenshot(s).')
+            if not max_rss_mb is None and not ssm.lastRss is None and ssm.lastRss > float(max_rss_mb) * 1024**2:
+                self.logger.info(f'Recycling the ScreenshotMaker, it uses {format(ssm.lastRss / 1024**2, ".1f")} MB (more than {max_rss_mb} MB).')
+                return True
+            if not max_renders is None and ssm.numRenders >= int(max_renders):
+                self.logger.info(f'Recycling the ScreenshotMaker after {ssm.numRenders} screenshots.')
+                return True
+            return False
+
+        def stats():
+            return {
+                'size': self.res_ssm.size,
+                'capacity': self.res_ssm.capacity,
+                'idle': self.res_ssm.numIdle,
+                'busy': self.res_ssm.numBusy,
+                'warm_hits': self.res_ssm.numWarmHits,
+                'cold_start_avoided': self.res_ssm.coldStartAvoided,
+                'recycled': self.res_ssm.numDiscarded,
+                'max_rss_mb': max_rss_mb,
+                'max_renders': max_renders,
+                'browsers': [{ 'renders': ssm.numRenders, 'live_updates': ssm.numLiveUpdates, 'rss': ssm.lastRss } for ssm in self.res_ssm.items],
+                'time_to_ready': dict(self._time_to_ready)
+            }
 
         def temp(which: str, **kwargs):
-            res_atom: AtomicResource[ScreenshotMaker] = None
             res: ScreenshotMaker = None
 
-            lock: InterProcessLock = None
-            lock_gotten = False
-
             try:
-                res_atom = self.res_ssm.value
-                res = res_atom.obtain()
+                res = self.res_ssm.obtain()
                 conf = self.getScreenConfig(name=which, **kwargs)
                 start = timer()
                 self.logger.debug(f'Taking screenshot of screen "{which}" in resolution {conf["width"]}x{conf["height"]}.')
-                blackimg, redimg = res.screenshot(**conf)
-
-                lock = InterProcessLock(path=abspath(join(self.data_folder, 'write.lock')))
-                lock_gotten = lock.acquire()
-
-                with open(file=abspath(join(self.data_folder, f'{which}_b.png')), mode='wb') as fp:
-                    blackimg.save(fp)
-                with open(file=abspath(join(self.data_folder, f'{which}_r.png')), mode='wb') as fp:
-                    redimg.save(fp)
+                # Pages that were opened with extra arguments cannot be updated.
+                fnData = self._views.get(f'/{conf["category"]}/{which}', None) if live_pages and len(kwargs) == 0 else None
+                live_data = None if fnData is None else dumps(fnData(), cls=MyJSONEncoder)
+                blackimg, redimg = res.screenshot(**conf, live_data=live_data)
+                self._time_to_ready[which] = res.lastTimeToReady
+                self.logger.debug(f'Screen "{which}" was ready after {format(res.lastTimeToReady, ".2f")} seconds.')
+
+                # Publishing is atomic, so there is no need to wait for readers.
+                self.getScreenPlanes().write(name=which, black_img=blackimg, red_img=redimg)
                 
                 self.logger.debug(f'Done taking screenshot of "{which}". It took {format(timer() - start, ".2f")} seconds.')
 
@@ -561,17 +622,33 @@ class Configurator:
             except Exception as e:
                 return f'ERROR: {str(e)}', 500
             finally:
-                if lock_gotten:
-                    lock.release()
                 if type(res) is ScreenshotMaker:
-                    res_atom.recover(item=res)
+                    if must_recycle(ssm=res):
+                        self.res_ssm.discard(item=res)
+                    else:
+                        self.res_ssm.recover(item=res)
 
         self.api.addRoute(route='/screens/<which>', fn=temp)
+        self.api.addRoute(route='/screenshot-service', fn=stats)
 
         self.logger.info(f'Finished setting up ScreenshotMaker.')
         
         return self
     
+    def _numScreensDue(self, within: float) -> int:
+        """
+        The number of scheduled screenshots that are due within the given
+        number of seconds (or are being taken right now).
+        """
+        deadline = monotonic() + within
+        return len(list(filter(lambda due: due <= deadline, list(self._screen_due.values()))))
+
+    def _prewarmScreenshotService(self, url: str):
+        count = self._numScreensDue(within=self._prewarm_before)
+        self.logger.debug(f'Pre-warming {count} ScreenshotMaker(s) for the screenshot of {url}.')
+        self.res_ssm.prewarm(count=count)
+        return self
+
     def _setScreenTimer(self, url: str, interval: int):
         def temp():
             try:
@@ -580,8 +657,11 @@ class Configurator:
                 self.logger.error(f'Cannot get URL {url} -- all retries exhausted.')
             finally:
                 self._setScreenTimer(url=url, interval=interval)
-        timer = Timer(interval=interval, function=temp)
-        timer.start()
+        task = scheduler.schedule(delay=float(interval), fn=temp, name=f'screen({url})')
+        self._screen_due[url] = task.deadline
+
+        if not self.res_ssm is None and float(interval) > self._prewarm_before:
+            scheduler.schedule(delay=float(interval) - self._prewarm_before, fn=lambda: self._prewarmScreenshotService(url=url), name=f'prewarm({url})')
 
         return self
     
@@ -608,6 +688,15 @@ class Configurator:
     def getGeneralConfig(self):
         return self.config['general']
 
+    def getScreenPlanes(self) -> ScreenPlanes:
+        """
+        The store of rendered planes, configured by the optional general
+        'planes' config (how many previous renders to keep per screen, and
+        for how many days).
+        """
+        planes = self.config['general'].get('planes', {})
+        return ScreenPlanes(data_folder=self.data_folder, keep=int(planes.get('keep', 5)), max_age=float(planes.get('max_age_days', 7)) * 24 * 3600.0)
+
     def getScreenConfig(self, name: str, **url_args):
         """
         Returns the config of a single screen by name, and also adds
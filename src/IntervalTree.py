@@ -0,0 +1,69 @@
+import numpy as np
+from typing import Union
+
+
+
+class _Node:
+    def __init__(self, center: float, idx: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+        self.center = center
+        # The intervals containing the center, once sorted by start and once by end.
+        self.by_start = idx[np.argsort(starts[idx], kind='stable')]
+        self.starts = starts[self.by_start]
+        self.by_end = idx[np.argsort(ends[idx], kind='stable')]
+        self.ends = ends[self.by_end]
+        self.left: Union[_Node, None] = None
+        self.right: Union[_Node, None] = None
+
+
+
+class IntervalTree:
+    """
+    A static, centered interval tree over intervals given as parallel arrays of
+    starts and ends. Intervals are referred to by their position in these
+    arrays. Finding all k intervals that strictly contain a point takes about
+    O(log n + k). Intervals without duration never contain any point and are
+    therefore not part of the tree.
+    """
+    def __init__(self, starts: np.ndarray, ends: np.ndarray):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        self._root = self._build(idx=np.flatnonzero(self.ends > self.starts))
+
+    def _build(self, idx: np.ndarray) -> Union[_Node, None]:
+        if len(idx) == 0:
+            return None
+
+        # Using the median midpoint of an actual interval guarantees that at
+        # least that interval is stored in this node, and that each subtree
+        # holds at most half of the remaining intervals.
+        mids = (self.starts[idx] + self.ends[idx]) / 2.0
+        center = float(np.partition(mids, len(mids) // 2)[len(mids) // 2])
+
+        starts, ends = self.starts[idx], self.ends[idx]
+        node = _Node(center=center, idx=idx[(starts < center) & (ends > center)], starts=self.starts, ends=self.ends)
+        node.left = self._build(idx=idx[ends <= center])
+        node.right = self._build(idx=idx[starts >= center])
+        return node
+
+    def containing(self, point: float) -> np.ndarray:
+        """
+        Returns the positions of all intervals with start < point < end.
+        """
+        found: list[np.ndarray] = []
+        node = self._root
+        while node is not None:
+            if point < node.center:
+                # All of the node's intervals end after the point.
+                found.append(node.by_start[:np.searchsorted(node.starts, point, side='left')])
+                node = node.left
+            elif point > node.center:
+                # All of the node's intervals start before the point.
+                found.append(node.by_end[np.searchsorted(node.ends, point, side='right'):])
+                node = node.right
+            else:
+                found.append(node.by_start)
+                break
+
+        if len(found) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(found)
@@ -0,0 +1,124 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+from typing import Any, Callable
+from src.CustomFormatter import CustomFormatter
+
+
+
+class ScheduledTask:
+    """
+    A deadline registered with a Scheduler. Similar to a threading.Timer, it
+    can be cancelled for as long as it is pending.
+    """
+    def __init__(self, scheduler: 'Scheduler', deadline: float, fn: Callable[[], Any], name: str=None):
+        self._scheduler = scheduler
+        self.deadline = deadline
+        self.fn = fn
+        self.name = name
+        self._seq: int = None
+        self._pending = True
+
+    @property
+    def pending(self) -> bool:
+        return self._pending
+
+    def cancel(self):
+        self._scheduler.cancel(task=self)
+        return self
+
+    def reschedule(self, delay: float):
+        self._scheduler.reschedule(task=self, delay=delay)
+        return self
+
+
+
+class Scheduler:
+    """
+    Runs all registered deadlines from a single thread, using a heap. Callbacks
+    that are due are handed off to a bounded pool of workers, such that long-
+    running callbacks do not delay other deadlines. The thread is only started
+    once the first deadline is registered.
+    """
+    def __init__(self, name: str='Scheduler', max_workers: int=16):
+        self.name = name
+        self._heap: list[tuple[float, int, ScheduledTask]] = []
+        self._seq = count()
+        self._cond = Condition()
+        self._thread: Thread = None
+        self._tpe = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.logger = CustomFormatter.getLoggerFor(f'{self.__class__.__name__}({name})')
+
+    @property
+    def numPending(self) -> int:
+        with self._cond:
+            return sum(1 for _, seq, task in self._heap if task._pending and task._seq == seq)
+
+    def _push(self, task: ScheduledTask):
+        # Entries of a task that was rescheduled or cancelled become invalid,
+        # because their sequence number is no longer the task's.
+        task._seq = next(self._seq)
+        task._pending = True
+        heapq.heappush(self._heap, (task.deadline, task._seq, task))
+
+        # Drop invalid entries if they make up the majority.
+        if len(self._heap) > 64 and len(self._heap) > 2 * sum(1 for _, seq, t in self._heap if t._pending and t._seq == seq):
+            self._heap = [entry for entry in self._heap if entry[2]._pending and entry[2]._seq == entry[1]]
+            heapq.heapify(self._heap)
+
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def schedule(self, delay: float, fn: Callable[[], Any], name: str=None) -> ScheduledTask:
+        task = ScheduledTask(scheduler=self, deadline=monotonic() + max(0.0, delay), fn=fn, name=name)
+        with self._cond:
+            self._push(task=task)
+        return task
+
+    def reschedule(self, task: ScheduledTask, delay: float) -> ScheduledTask:
+        with self._cond:
+            task.deadline = monotonic() + max(0.0, delay)
+            self._push(task=task)
+        return task
+
+    def cancel(self, task: ScheduledTask) -> ScheduledTask:
+        with self._cond:
+            task._pending = False
+            self._cond.notify()
+        return task
+
+    def _run(self):
+        while True:
+            due: list[ScheduledTask] = []
+            with self._cond:
+                while len(self._heap) > 0:
+                    deadline, seq, task = self._heap[0]
+                    if not task._pending or task._seq != seq:
+                        heapq.heappop(self._heap)
+                    elif deadline <= monotonic():
+                        heapq.heappop(self._heap)
+                        task._pending = False
+                        due.append(task)
+                    else:
+                        break
+
+                if len(due) == 0:
+                    self._cond.wait(timeout=None if len(self._heap) == 0 else self._heap[0][0] - monotonic())
+
+            for task in due:
+                self._tpe.submit(self._execute, task)
+
+    def _execute(self, task: ScheduledTask):
+        try:
+            task.fn()
+        except Exception as e:
+            self.logger.error(f'Scheduled task "{task.name}" caused an exception: {str(e)}')
+
+
+
+# The scheduler that all self-resetting caches and state timers share.
+scheduler = Scheduler()
@@ -0,0 +1,239 @@
+import os
+import mmap
+import pathlib
+from glob import escape, glob
+from hashlib import sha256
+from json import dumps, load
+from os.path import abspath, basename, exists, getmtime, getsize, join
+from time import time
+from typing import Any, Callable, IO, Union
+from uuid import uuid4
+from PIL import Image
+from src.CustomFormatter import CustomFormatter
+from src.epd7in5b_V2 import EPD_FRAME_SIZE, FRAME_ONES, FRAME_ZEROS, imageToBuffer
+
+
+
+class ScreenPlanes:
+    """
+    Reads and writes the rendered black and red planes of screens in the data
+    folder. Next to the PNGs (<name>_b.png, <name>_r.png), which are used for
+    previews, the planes are also stored as packed 1-bit buffers that can be
+    sent to the e-paper as they are.
+
+    The buffers are stored by their content's hash (planes/objects/<hash>.bin),
+    so identical planes are only stored once. A manifest per screen
+    (planes/<name>.json) points to the current pair of planes and keeps a short
+    history of previous ones. Writing planes that are already current is a
+    no-op, and planes that were rendered before are reused without writing
+    them again.
+
+    Planes are published without any locks: Objects and manifests are written
+    to temporary files first, which then atomically replace the actual files.
+    Readers only follow the manifest, so they always get a matching pair of
+    planes, and never see partially written files.
+
+    Objects are garbage-collected once no manifest refers to them any longer,
+    i.e., once they dropped out of every history, which keeps at most 'keep'
+    entries that are not older than 'max_age' seconds (the current one is
+    always kept).
+    """
+    def __init__(self, data_folder: str, keep: int=5, max_age: float=7 * 24 * 3600.0, gc_grace: float=60.0):
+        self.data_folder = data_folder
+        self.keep = max(1, keep)
+        self.max_age = max_age
+        # Objects that were written or reused that recently are never removed,
+        # because a concurrent writer may be about to publish them.
+        self.gc_grace = gc_grace
+        self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
+
+    @property
+    def storeFolder(self) -> str:
+        return abspath(join(self.data_folder, 'planes'))
+
+    def pngPaths(self, name: str) -> tuple[str, str]:
+        return abspath(join(self.data_folder, f'{name}_b.png')), abspath(join(self.data_folder, f'{name}_r.png'))
+
+    def manifestPath(self, name: str) -> str:
+        return join(self.storeFolder, f'{name}.json')
+
+    def objectPath(self, digest: str) -> str:
+        return join(self.storeFolder, 'objects', f'{digest}.bin')
+
+    def toPanelBuffers(self, black_img: Image.Image, red_img: Image.Image) -> tuple[bytes, bytes]:
+        """
+        Converts both planes into the buffers as the e-paper expects them: The
+        black plane as it comes from PIL, but the red plane inverted (1=red).
+        Planes with wrong dimensions result in blank buffers.
+        """
+        black = imageToBuffer(black_img, invert=False)
+        red = imageToBuffer(red_img)
+        return FRAME_ONES if black is None else black, FRAME_ZEROS if red is None else red
+
+    @staticmethod
+    def _writeAtomically(path: str, fn: Callable[[IO], Any]):
+        """
+        Writes to a temporary file first, which then replaces the file at path.
+        """
+        temp_path = f'{path}.{uuid4().hex}.tmp'
+        try:
+            with open(file=temp_path, mode='wb') as fp:
+                fn(fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp_path, path)
+        finally:
+            if exists(temp_path):
+                os.remove(temp_path)
+
+    def manifest(self, name: str) -> Union[dict[str, Any], None]:
+        """
+        The manifest of the screen's planes, or None if there is none.
+        """
+        try:
+            with open(file=self.manifestPath(name=name), mode='r', encoding='utf-8') as fp:
+                return load(fp)
+        except FileNotFoundError:
+            return None
+
+    def current(self, name: str) -> Union[dict[str, Any], None]:
+        """
+        The manifest's entry of the current planes, or None if there are none.
+        """
+        manifest = self.manifest(name=name)
+        return None if manifest is None else manifest['current']
+
+    def _storeObject(self, buf: bytes) -> str:
+        digest = sha256(buf).hexdigest()
+        path = self.objectPath(digest=digest)
+        if exists(path):
+            # Reused, so protect it from being collected right now.
+            os.utime(path)
+        else:
+            ScreenPlanes._writeAtomically(path=path, fn=lambda fp: fp.write(buf))
+        return digest
+
+    def write(self, name: str, black_img: Image.Image, red_img: Image.Image):
+        black_buf, red_buf = self.toPanelBuffers(black_img=black_img, red_img=red_img)
+        black_digest, red_digest = sha256(black_buf).hexdigest(), sha256(red_buf).hexdigest()
+
+        manifest = self.manifest(name=name)
+        current = None if manifest is None else manifest['current']
+        if not current is None and current['black'] == black_digest and current['red'] == red_digest and exists(self.objectPath(digest=black_digest)) and exists(self.objectPath(digest=red_digest)):
+            self.logger.debug(f'The planes of "{name}" did not change.')
+            return self
+
+        pathlib.Path(join(self.storeFolder, 'objects')).mkdir(parents=True, exist_ok=True)
+        self._storeObject(buf=black_buf)
+        self._storeObject(buf=red_buf)
+
+        file_black, file_red = self.pngPaths(name=name)
+        ScreenPlanes._writeAtomically(path=file_black, fn=lambda fp: black_img.save(fp, format='PNG'))
+        ScreenPlanes._writeAtomically(path=file_red, fn=lambda fp: red_img.save(fp, format='PNG'))
+
+        h = sha256()
+        h.update(black_buf)
+        h.update(red_buf)
+        now = time()
+        entry = {
+            'black': black_digest,
+            'red': red_digest,
+            'hash': f'bin:{h.hexdigest()}',
+            'created': now
+        }
+        history = [] if manifest is None else manifest['history']
+        history = [entry] + list(filter(lambda e: e['hash'] != entry['hash'] and (now - e['created']) <= self.max_age, history))
+        manifest = {
+            'generation': 1 if manifest is None else int(manifest['generation']) + 1,
+            'current': entry,
+            'history': history[0:self.keep]
+        }
+        ScreenPlanes._writeAtomically(path=self.manifestPath(name=name), fn=lambda fp: fp.write(dumps(manifest).encode('utf-8')))
+
+        self.collectGarbage()
+        return self
+
+    def collectGarbage(self) -> int:
+        """
+        Removes all objects that no manifest refers to. Returns their number.
+        """
+        referenced: set[str] = set()
+        for path in glob(join(escape(self.storeFolder), '*.json')):
+            try:
+                with open(file=path, mode='r', encoding='utf-8') as fp:
+                    manifest = load(fp)
+                for entry in [manifest['current']] + manifest['history']:
+                    referenced.update((entry['black'], entry['red']))
+            except Exception as e:
+                # Better to keep everything than to remove what is in use.
+                self.logger.warning(f'Cannot read manifest {path}, not collecting garbage: {str(e)}')
+                return 0
+
+        removed = 0
+        now = time()
+        for path in glob(join(escape(self.storeFolder), 'objects', '*.bin')):
+            try:
+                if not basename(path)[0:-4] in referenced and (now - getmtime(path)) > self.gc_grace:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass # Gone already, or still in use (Windows)
+
+        if removed > 0:
+            self.logger.debug(f'Removed {removed} plane(s) that were no longer referenced.')
+        return removed
+
+    def hasBuffers(self, name: str) -> bool:
+        """
+        True if the current planes were stored as buffers of the right size.
+        """
+        current = self.current(name=name)
+        if current is None:
+            return False
+        for digest in (current['black'], current['red']):
+            path = self.objectPath(digest=digest)
+            if not exists(path) or getsize(path) != EPD_FRAME_SIZE:
+                return False
+        return True
+
+    def planesHash(self, name: str) -> Union[str, None]:
+        """
+        A hash of the planes' content, taken from the manifest if possible, or
+        otherwise from the PNGs. None if there are neither.
+        """
+        current = self.current(name=name)
+        if not current is None:
+            return current['hash']
+
+        paths = self.pngPaths(name=name)
+        if not all(exists(path) for path in paths):
+            return None
+        h = sha256()
+        for path in paths:
+            with open(file=path, mode='rb') as fp:
+                h.update(fp.read())
+        return f'png:{h.hexdigest()}'
+
+    def openBuffers(self, name: str, attempts: int=3) -> tuple[mmap.mmap, mmap.mmap, str]:
+        """
+        Memory-maps both current buffers for reading, and returns them together
+        with their hash. The caller has to close them. If the planes were
+        collected in the meantime, the then current ones are used.
+        """
+        while True:
+            attempts -= 1
+            current = self.current(name=name)
+            if current is None:
+                raise FileNotFoundError(f'There are no planes of "{name}".')
+
+            maps: list[mmap.mmap] = []
+            try:
+                for digest in (current['black'], current['red']):
+                    with open(file=self.objectPath(digest=digest), mode='rb') as fp:
+                        maps.append(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+                return maps[0], maps[1], current['hash']
+            except Exception as e:
+                for m in maps:
+                    m.close()
+                if attempts <= 0 or not type(e) is FileNotFoundError:
+                    raise e
@@ -1,15 +1,89 @@
 import io
 import os
-from time import sleep
+from glob import glob
+from timeit import default_timer as timer
+from typing import Union
 from PIL import Image #, ImageOps, ImageEnhance
 from selenium import webdriver
-from concurrent.futures import Future
-from threading import Thread
+from selenium.common.exceptions import TimeoutException
+from src.ColorSeparation import separatePlanes
+
+
+# Resolves once an element with the id given as first argument exists. Pages
+# signal that they are ready by appending such an element (#ready).
+_WAIT_FOR_ELEMENT = """
+const id = arguments[0], done = arguments[arguments.length - 1];
+if (document.getElementById(id)) {
+    done(true);
+    return;
+}
+const observer = new MutationObserver(() => {
+    if (document.getElementById(id)) {
+        observer.disconnect();
+        done(true);
+    }
+});
+observer.observe(document, { childList: true, subtree: true });
+"""
+
+# Pushes the view's data (a JSON string) into an open page, which renders it
+# again (see web/assets/live.js). Resolves to false if the page does not
+# support that.
+_LIVE_UPDATE = """
+const data = JSON.parse(arguments[0]), done = arguments[arguments.length - 1];
+if (typeof window.liveUpdate !== 'function') {
+    done(false);
+    return;
+}
+window.liveUpdate(data).then(() => done(true), e => done(`${e}`));
+"""
+
+
+def _processTreeRss(pid: int) -> Union[int, None]:
+    """
+    The summed resident set size in bytes of a process and all of its
+    descendants, read from /proc. None if that is not available (not Linux).
+    """
+    if not os.path.isdir('/proc'):
+        return None
+
+    children: dict[int, list[int]] = {}
+    for path in glob('/proc/[0-9]*/stat'):
+        try:
+            with open(file=path, mode='r') as fp:
+                stat = fp.read()
+            # The command may contain spaces and parentheses, the rest does not.
+            fields = stat[stat.rindex(')') + 2:].split()
+            children.setdefault(int(fields[1]), []).append(int(os.path.basename(os.path.dirname(path))))
+        except (OSError, ValueError, IndexError):
+            pass # The process is gone already.
+
+    rss = 0
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    pids = [pid]
+    while len(pids) > 0:
+        p = pids.pop()
+        pids.extend(children.get(p, []))
+        try:
+            with open(file=f'/proc/{p}/statm', mode='r') as fp:
+                rss += int(fp.read().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            pass
+    return rss
+
 
 
 class ScreenshotMaker:
 
     def __init__(self, driver: str='gecko'):
+        self.numRenders = 0
+        # The memory usage after the last render, see memoryUsage().
+        self.lastRss: int = None
+        # Seconds from loading the page until it was ready, of the last render.
+        self.lastTimeToReady: float = None
+        self.numLiveUpdates = 0
+        # The windows that keep live pages open (by URL).
+        self._live_windows: dict[str, str] = {}
         if driver == 'gecko':
             options = webdriver.FirefoxOptions()
             options.add_argument('--headless')
@@ -25,6 +99,7 @@ class ScreenshotMaker:
             self.driver = webdriver.Chrome(options=chrome_options)
         else:
             raise Exception(f'Driver "{driver}" not known.')
+        self._main_window = self.driver.current_window_handle
     
     def __del__(self):
         try:
@@ -33,6 +108,26 @@ class ScreenshotMaker:
         except Exception:
             pass # don't care at all, we just want it gone!
 
+    def memoryUsage(self) -> Union[int, None]:
+        """
+        The resident set size in bytes of the driver and the browser processes
+        together, or None if that cannot be determined.
+        """
+        try:
+            return _processTreeRss(pid=self.driver.service.process.pid)
+        except Exception:
+            return None
+
+    def isHealthy(self) -> bool:
+        """
+        True if the browser still responds, i.e., has not crashed or hung up.
+        """
+        try:
+            self.driver.current_url
+            return True
+        except Exception:
+            return False
+
 
     def setViewportSize(self, width, height):
         # Extract the current window size from the driver
@@ -51,31 +146,86 @@ class ScreenshotMaker:
 
         return self
     
-    def waitForElement(self, id: str, max_wait: float=60.0) -> Future[bool]:
-        f = Future()
-
-        def sel(max_wait: float) -> bool:
-            while max_wait > 0:
-                try:
-                    self.driver.find_element_by_id(id)
-                    f.set_result(True)
-                    return True
-                except:
-                    sleep(0.25)
-                finally:
-                    max_wait -= 0.25
-            f.set_result(False)
-
-        Thread(target=sel, args=(max_wait,)).start()
-        return f
+    def waitForElement(self, id: str, max_wait: float=60.0) -> bool:
+        """
+        Blocks until the page contains an element with the given id, or until
+        max_wait seconds have passed. Instead of polling, the page itself
+        signals once the element was added.
+        """
+        self.driver.set_script_timeout(max_wait)
+        try:
+            return self.driver.execute_async_script(_WAIT_FOR_ELEMENT, id) == True
+        except TimeoutException:
+            return False
     
-    def screenshot(self, width: int, height: int, url: str, **kwargs) -> list[Image.Image, Image.Image]:
+    def _update(self, url: str, live_data: str, width: int, height: int, max_wait: float) -> bool:
+        """
+        Pushes the data into the live page of the URL, if there is one. False
+        if the page has to be loaded instead.
+        """
+        if not url in self._live_windows:
+            return False
+
+        self.driver.switch_to.window(self._live_windows[url])
         self.setViewportSize(width=width, height=height)
-        self.driver.get(url=url)
-        if not self.waitForElement(id='ready').result():
-            raise Exception('Waiting for page to load timed out.')
-        
-        img_bytes = self.driver.get_screenshot_as_png()
+        self.driver.set_script_timeout(max_wait)
+        try:
+            result = self.driver.execute_async_script(_LIVE_UPDATE, live_data)
+        except TimeoutException:
+            raise Exception(f'Updating the page timed out after {format(max_wait, ".2f")} seconds.')
+        if result == True:
+            self.numLiveUpdates += 1
+            return True
+        if result == False:
+            return False
+        raise Exception(f'Updating the page failed: {result}')
+
+    def _closeLiveWindow(self, url: str):
+        handle = self._live_windows.pop(url, None)
+        try:
+            if not handle is None:
+                self.driver.switch_to.window(handle)
+                self.driver.close()
+        except Exception:
+            pass # It is gone already.
+        finally:
+            self.driver.switch_to.window(self._main_window)
+
+    def screenshot(self, width: int, height: int, url: str, ready_timeout: float=60.0, live_data: str=None, **kwargs) -> list[Image.Image, Image.Image]:
+        """
+        Loads the page and takes a screenshot once it is ready. If the view's
+        data is given as JSON (live_data), the page is kept open in a window of
+        its own, and later screenshots of the same URL push their data into it
+        instead of loading it again.
+        """
+        try:
+            start = timer()
+            if live_data is None:
+                self.driver.switch_to.window(self._main_window)
+                self.setViewportSize(width=width, height=height)
+                self.driver.get(url=url)
+            elif not self._update(url=url, live_data=live_data, width=width, height=height, max_wait=float(ready_timeout)):
+                if not url in self._live_windows:
+                    self.driver.switch_to.new_window('tab')
+                    self._live_windows[url] = self.driver.current_window_handle
+                self.setViewportSize(width=width, height=height)
+                self.driver.get(url=url)
+
+            if not self.waitForElement(id='ready', max_wait=max(0.1, float(ready_timeout) - (timer() - start))):
+                raise Exception(f'Waiting for page to load timed out after {format(timer() - start, ".2f")} seconds.')
+            self.lastTimeToReady = timer() - start
+            
+            img_bytes = self.driver.get_screenshot_as_png()
+        except Exception as e:
+            if not live_data is None:
+                # Start over with a freshly loaded page next time.
+                self._closeLiveWindow(url=url)
+            raise e
+        finally:
+            # The browser grows with every page it loads, successful or not.
+            self.numRenders += 1
+            self.lastRss = self.memoryUsage()
+
         img = Image.open(io.BytesIO(initial_bytes=img_bytes))
         img = img.crop((0, 0, width, height))
 
@@ -89,16 +239,4 @@ class ScreenshotMaker:
         #img = ImageOps.grayscale(img)
 
         # Also, let's return a red and a black image:
-        redimg = img.copy()
-        rpixels = redimg.load()
-        blackimg = img
-        bpixels = blackimg.load()
-
-        for i in range(redimg.size[0]):
-            for j in range(redimg.size[1]):
-                if rpixels[i, j][0] <= rpixels[i, j][1] and rpixels[i, j][0] <= rpixels[i, j][2]:
-                    rpixels[i, j] = (255, 255, 255)
-                elif bpixels[i, j][0] > bpixels[i, j][1] and bpixels[i, j][0] > bpixels[i, j][2]:
-                    bpixels[i, j] = (255, 255, 255)
-
-        return blackimg, redimg
+        return separatePlanes(img)
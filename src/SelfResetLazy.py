@@ -1,26 +1,43 @@
-from concurrent.futures import Future
-from threading import Semaphore, Timer, Thread
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Semaphore
 from typing import Callable, TypeVar, Generic, Any, Union
 from timeit import default_timer as timer
 from src.CustomFormatter import CustomFormatter
-from queue import Queue
+from src.Scheduler import ScheduledTask, scheduler
 
 
 T = TypeVar('T')
 
 
+# Shared by all instances to produce values asynchronously (see valueFuture).
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='SelfResetLazy')
+
 
 class SelfResetLazy(Generic[T]):
-    def __init__(self, resource_name: str, fnCreateVal: Callable[[], T], fnDestroyVal: Callable[[T], Any]=None, resetAfter: float=None) -> None:
+    def __init__(self, resource_name: str, fnCreateVal: Callable[[], T], fnDestroyVal: Callable[[T], Any]=None, resetAfter: float=None, staleWhileRevalidate: bool=False) -> None:
+        """
+        If staleWhileRevalidate is True, the value is not destroyed once the
+        timer fires. Instead, a new value is produced in the background, while
+        readers keep getting the previous value. If producing the new value
+        fails, the previous value is kept and marked as stale.
+        """
         self.resource_name = resource_name
         self._val: T = None
         self._has_val = False
+        self._val_created: float = None
+        self._is_stale = False
         self._semaphore = Semaphore(1)
+        self._staleWhileRevalidate = staleWhileRevalidate
+        # The pending Future for a value that is being produced, if any.
+        self._future: Future[T] = None
+        self._future_semaphore = Semaphore(1)
+        # True while a new value is being produced by revalidate().
+        self._revalidating = False
 
         self._fnCreateVal = fnCreateVal
         self._fnDestroyVal = fnDestroyVal
         self._resetAfter = resetAfter
-        self._timer: Timer = None
+        self._timer: ScheduledTask = None
 
         self.logger = CustomFormatter.getLoggerFor(
             f'{self.__class__.__name__}({resource_name})')
@@ -53,6 +70,8 @@ class SelfResetLazy(Generic[T]):
                     self._fnDestroyVal(self._val) # Pass in the current value
                 self._val = None
                 self._has_val = False
+                self._val_created = None
+                self._is_stale = False
         except Exception as e:
             if handle_ex:
                 self.logger.error(f'Unsetting the value using "fnDestroyVal()" caused an exception: {str(e)}')
@@ -64,14 +83,79 @@ class SelfResetLazy(Generic[T]):
         return self
     
     def _setTimer(self):
-        if type(self._timer) is Timer and self._timer.is_alive():
+        if type(self._timer) is ScheduledTask and self._timer.pending:
             self._timer.cancel()
             self._timer = None
 
         if type(self._resetAfter) is float and self._resetAfter > 0.0:
             self.logger.debug(f'Setting timer for automatic destruction of value after {format(self._resetAfter, ".2f")} seconds.')
-            self._timer = Timer(interval=self._resetAfter, function=self.unsetValue)
-            self._timer.start()
+            self._timer = scheduler.schedule(
+                delay=self._resetAfter, fn=self.revalidate if self._staleWhileRevalidate else self.unsetValue,
+                name=f'{self.__class__.__name__}({self.resource_name})')
+        return self
+
+    def revalidate(self):
+        """
+        Produces a new value in stale-while-revalidate fashion, like the timer
+        does, unless that is already happening. Readers keep getting the current
+        value in the meantime.
+        """
+        try:
+            self._semaphore.acquire()
+            if self._revalidating:
+                return self
+            self._revalidating = True
+        finally:
+            self._semaphore.release()
+
+        try:
+            return self._revalidate()
+        finally:
+            self._revalidating = False
+
+    def _revalidate(self):
+        """
+        Produces a new value without holding the lock, such that readers are
+        not blocked in the meantime. Use revalidate() instead.
+        """
+        if not self.hasValue:
+            return self # Nothing to revalidate, the next access will create it.
+
+        try:
+            start = timer()
+            self.logger.debug('Calling "fnCreateVal()" to revalidate the value in the background.')
+            val = self._fnCreateVal()
+            self.logger.debug(f'"fnCreateVal()" took {format(timer() - start, ".2f")} seconds to revalidate the value.')
+        except Exception as e:
+            try:
+                self._semaphore.acquire()
+                if self._has_val:
+                    self._is_stale = True
+                    self.logger.error(f'Cannot revalidate value, keeping the previous value (age: {format(self.valueAge, ".2f")} seconds). Exception was: {str(e)}')
+                    self._setTimer() # Try again later
+            finally:
+                self._semaphore.release()
+            return self
+
+        old_val: T = None
+        try:
+            self._semaphore.acquire()
+            old_val = self._val
+            self._val = val
+            self._has_val = True
+            self._val_created = timer()
+            self._is_stale = False
+            self._setTimer()
+        finally:
+            self._semaphore.release()
+
+        try:
+            if callable(self._fnDestroyVal) and old_val is not val:
+                self.logger.debug('Attempting to destroy the previous value by calling "fnDestroyVal()".')
+                self._fnDestroyVal(old_val)
+        except Exception as e:
+            self.logger.error(f'Destroying the previous value using "fnDestroyVal()" caused an exception: {str(e)}')
+
         return self
 
     @property
@@ -86,9 +170,26 @@ class SelfResetLazy(Generic[T]):
         finally:
             self._semaphore.release()
 
+    @property
     def valueVolatile(self) -> Union[None, T]:
         return self._val
 
+    @property
+    def valueAge(self) -> Union[None, float]:
+        """
+        The age of the current value in seconds, or None if there is no value.
+        """
+        created = self._val_created
+        return None if created is None else timer() - created
+
+    @property
+    def isStale(self) -> bool:
+        """
+        Only in stale-while-revalidate mode: True if the current value could not
+        be revalidated and is therefore older than intended.
+        """
+        return self._is_stale
+
     @property
     def value(self) -> T:
         try:
@@ -98,6 +199,8 @@ class SelfResetLazy(Generic[T]):
                 self.logger.debug(f'Calling "fnCreateVal()" to lazily produce value.')
                 self._val = self._fnCreateVal()
                 self._has_val = True
+                self._val_created = timer()
+                self._is_stale = False
                 self.logger.debug(f'"fnCreateVal()" took {format(timer() - start, ".2f")} seconds to produce a value.')
                 self._setTimer()
             return self._val
@@ -109,52 +212,283 @@ class SelfResetLazy(Generic[T]):
 
     @property
     def valueFuture(self) -> Future[T]:
-        f = Future()
+        """
+        Returns a resolved Future if a value is present. Otherwise, the value is
+        produced on a shared executor, and all callers in the meantime get the
+        same Future.
+        """
+        # Do not block if the value is currently being produced.
+        if self._semaphore.acquire(blocking=False):
+            try:
+                if self._has_val:
+                    f = Future()
+                    f.set_result(self._val)
+                    return f
+            finally:
+                self._semaphore.release()
 
-        temp = self._val
-        if type(temp) is T and self.hasValueVolatile:
-            f.set_result(temp)
-        else:
-            def setVal():
-                try:
-                    f.set_result(self.value)
-                except Exception as e:
-                    f.set_exception(e)
-            Thread(target=setVal).start()
+        try:
+            self._future_semaphore.acquire()
+            if self._future is None or self._future.done():
+                self._future = _executor.submit(lambda: self.value)
+            return self._future
+        finally:
+            self._future_semaphore.release()
 
-        return f
 
 
+class ResourcePool(Generic[T]):
+    """
+    Holds up to 'capacity' items, which are produced lazily by fnCreate() once
+    all existing items are in use. Obtaining an item blocks until one is
+    available, or raises after 'timeout' seconds. With a capacity of 1, it
+    serializes access to a single item.
 
-class AtomicResource(Generic[T]):
-    def __init__(self, resource_name: str=None, item: T=None) -> None:
-        self._queue = Queue(maxsize=1)
+    Before an idle item is handed out, it is checked using fnHealthy(), and
+    unhealthy items are destroyed and replaced. Items that were not used for
+    'idleAfter' seconds are destroyed, so the pool shrinks when it is not used,
+    except for as many items as fnWarm() returns, which are expected to be
+    needed soon. Items can also be produced ahead of time using prewarm().
+    """
+    def __init__(self, resource_name: str, fnCreate: Callable[[], T], fnDestroy: Callable[[T], Any]=None, fnHealthy: Callable[[T], bool]=None, fnWarm: Callable[[], int]=None, capacity: int=1, timeout: float=None, idleAfter: float=None) -> None:
         self.resource_name = resource_name
+        self.capacity = max(1, capacity)
+        self.timeout = timeout
+        self.idleAfter = idleAfter
+        self._fnCreate = fnCreate
+        self._fnDestroy = fnDestroy
+        self._fnHealthy = fnHealthy
+        self._fnWarm = fnWarm
+
+        # Idle items with the time they were recovered, the most recent last.
+        # The flag tells if the item only exists because it was pre-warmed or
+        # kept warm, i.e., obtaining it avoids producing a new one.
+        self._idle: list[tuple[T, float, bool]] = []
+        # All items, including those that are in use or still being created.
+        self._size = 0
+        # All items (by id), with how long it took to produce them.
+        self._items: dict[int, tuple[T, float]] = {}
+        self._cond = Condition()
+        self._timer: ScheduledTask = None
+        # Pre-warming has its own thread, so that it never waits for (or holds
+        # up) the values of SelfResetLazy instances.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{self.__class__.__name__}({resource_name})')
+
+        self.numWarmHits = 0
+        self.coldStartAvoided = 0.0
+        self.numDiscarded = 0
 
         self.logger = CustomFormatter.getLoggerFor(
             f'{self.__class__.__name__}({resource_name})')
 
-        if not item is None:
-            self.recover(item)
+    @property
+    def size(self) -> int:
+        return self._size
 
     @property
-    def available(self):
-        return self._queue.full()
+    def numIdle(self) -> int:
+        return len(self._idle)
 
     @property
-    def busy(self):
-        return self._queue.empty()
-
-    def obtain(self) -> T:
-        # Block until available.
-        self.logger.debug('Attempt to obtain item.')
-        item = self._queue.get(block=True, timeout=None)
-        self.logger.debug('Obtained item.')
-        return item
-
-    def recover(self, item: T):
-        # This'll throw if queue not empty.
-        # Momentarily, we don't care if the recovered item is the same as was obtained.
-        self._queue.put_nowait(item=item)
+    def numBusy(self) -> int:
+        return self._size - len(self._idle)
+
+    @property
+    def items(self) -> list[T]:
+        """
+        All existing items, whether they are idle or in use.
+        """
+        return [item for item, _ in list(self._items.values())]
+
+    def _create(self) -> T:
+        try:
+            start = timer()
+            item = self._fnCreate()
+            took = timer() - start
+            self._items[id(item)] = (item, took)
+            self.logger.debug(f'"fnCreate()" took {format(took, ".2f")} seconds to produce item {self._size} of {self.capacity}.')
+            return item
+        except Exception as e:
+            self.logger.error(f'Cannot produce an item. Exception was: {str(e)}')
+            self._release()
+            raise e
+
+    def _release(self):
+        """
+        Frees the slot of an item that no longer exists.
+        """
+        try:
+            self._cond.acquire()
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _destroy(self, item: T):
+        try:
+            self._items.pop(id(item), None)
+            if callable(self._fnDestroy):
+                self._fnDestroy(item)
+        except Exception as e:
+            self.logger.error(f'Destroying an item using "fnDestroy()" caused an exception: {str(e)}')
+        finally:
+            self._release()
+
+    def _isHealthy(self, item: T) -> bool:
+        try:
+            return not callable(self._fnHealthy) or self._fnHealthy(item)
+        except Exception as e:
+            self.logger.debug(f'Health check caused an exception: {str(e)}')
+            return False
+
+    def obtain(self, timeout: float=None) -> T:
+        """
+        Returns an idle item, or produces a new one if the pool is not full.
+        Otherwise, blocks until an item is recovered or discarded. Uses the
+        pool's timeout if none is given.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else timer() + timeout
+
+        while True:
+            item: T = None
+            warm = False
+            create = False
+            try:
+                self._cond.acquire()
+                while True:
+                    if len(self._idle) > 0:
+                        item, _, warm = self._idle.pop()
+                        break
+                    if self._size < self.capacity:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = None if deadline is None else deadline - timer()
+                    if not remaining is None and remaining <= 0.0:
+                        raise Exception(f'No item became available within {format(timeout, ".2f")} seconds ({self._size} in use).')
+                    self._cond.wait(timeout=remaining)
+            finally:
+                self._cond.release()
+
+            if create:
+                return self._create()
+            if self._isHealthy(item):
+                if warm:
+                    avoided = self._items.get(id(item), (item, 0.0))[1]
+                    self.numWarmHits += 1
+                    self.coldStartAvoided += avoided
+                    self.logger.info(f'Obtained a warm item, which avoided producing one ({format(avoided, ".2f")} seconds, {format(self.coldStartAvoided, ".2f")} seconds in total).')
+                else:
+                    self.logger.debug('Obtained item.')
+                return item
+
+            self.logger.warning('An idle item failed its health check, replacing it.')
+            self._destroy(item)
+
+    def recover(self, item: T, warm: bool=False):
+        """
+        Puts an obtained item back into the pool.
+        """
+        try:
+            self._cond.acquire()
+            self._idle.append((item, timer(), warm))
+            self._cond.notify()
+            self._setTimer()
+        finally:
+            self._cond.release()
         self.logger.debug('Recovered item.')
         return self
+
+    def discard(self, item: T):
+        """
+        Destroys an obtained item instead of putting it back, e.g., because it
+        is known to be broken. Its slot becomes available again.
+        """
+        self.numDiscarded += 1
+        self._destroy(item)
+        return self
+
+    def prewarm(self, count: int=1) -> Future[int]:
+        """
+        Produces items on the pool's own thread until there are at least 'count'
+        of them (at most 'capacity'), such that obtaining them later does not
+        have to wait. Resolves to the number of items produced.
+        """
+        def produce() -> int:
+            produced = 0
+            while True:
+                try:
+                    self._cond.acquire()
+                    if self._size >= min(count, self.capacity):
+                        break
+                    self._size += 1
+                finally:
+                    self._cond.release()
+                self.recover(item=self._create(), warm=True)
+                produced += 1
+            if produced > 0:
+                self.logger.debug(f'Pre-warmed {produced} item(s).')
+            return produced
+
+        return self._executor.submit(produce)
+
+    def _setTimer(self):
+        # Must be called while holding the lock.
+        if not type(self.idleAfter) is float or self.idleAfter <= 0.0 or len(self._idle) == 0:
+            return
+        if type(self._timer) is ScheduledTask and self._timer.pending:
+            return
+
+        # The least recently used item is the first one to expire.
+        delay = max(0.0, self._idle[0][1] + self.idleAfter - timer())
+        self._timer = scheduler.schedule(delay=delay, fn=self._reap, name=f'{self.__class__.__name__}({self.resource_name})')
+
+    def _reap(self):
+        warm = 0
+        if callable(self._fnWarm):
+            try:
+                warm = self._fnWarm()
+            except Exception as e:
+                self.logger.error(f'"fnWarm()" caused an exception: {str(e)}')
+
+        expired: list[T] = []
+        try:
+            self._cond.acquire()
+            now = timer()
+            # Idle items that have to be kept because they are needed soon.
+            keep = max(0, min(warm, self.capacity) - self.numBusy)
+            while len(self._idle) > 0 and (now - self._idle[0][1]) >= self.idleAfter:
+                item, _, _ = self._idle.pop(0)
+                if len(self._idle) + 1 > keep:
+                    expired.append(item)
+                else:
+                    # Kept warm: Obtaining it later avoids producing a new one.
+                    self._idle.append((item, now, True))
+            self._timer = None
+            self._setTimer()
+        finally:
+            self._cond.release()
+
+        if len(expired) > 0:
+            self.logger.debug(f'Destroying {len(expired)} item(s) that were idle for {format(self.idleAfter, ".2f")} seconds.')
+        for item in expired:
+            self._destroy(item)
+
+    def clear(self):
+        """
+        Destroys all idle items. Items in use are not affected.
+        """
+        try:
+            self._cond.acquire()
+            idle = [item for item, _, _ in self._idle]
+            self._idle.clear()
+            if type(self._timer) is ScheduledTask and self._timer.pending:
+                self._timer.cancel()
+            self._timer = None
+        finally:
+            self._cond.release()
+
+        for item in idle:
+            self._destroy(item)
+        return self
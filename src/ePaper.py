@@ -1,33 +1,148 @@
-import os
+import numpy as np
+from enum import Enum
 from PIL import Image
 from src.CustomFormatter import CustomFormatter
-from threading import Timer
+from src.Scheduler import ScheduledTask, scheduler
+from threading import Semaphore, Timer
+from timeit import default_timer as timer
+from src.epd7in5b_V2 import EPD, EPD_HEIGHT, EPD_WIDTH
+from typing import Union
+
+
+class POWER_STATE(Enum):
+    # Initialized and powered on, ready to refresh.
+    ACTIVE = 'active'
+    # Initialized, but the booster is off. Only needs to power on again.
+    POWERED_OFF = 'powered-off'
+    # Not initialized (or in deep sleep). Needs a reset and full initialization.
+    DEEP_SLEEP = 'deep-sleep'
+
+
+def changedWindow(old_black: bytes, old_red: bytes, new_black: bytes, new_red: bytes, width: int=EPD_WIDTH, height: int=EPD_HEIGHT) -> Union[tuple[int, int, int, int], None]:
+    """
+    Returns the bounding box (x, y, width, height) of all pixels that differ
+    between the old and the new panel buffers, with x and width aligned to 8
+    pixels (one byte). Returns None if nothing changed.
+    """
+    shape = (height, int(width / 8))
+    changed = np.frombuffer(old_black, dtype=np.uint8).reshape(shape) != np.frombuffer(new_black, dtype=np.uint8).reshape(shape)
+    changed |= np.frombuffer(old_red, dtype=np.uint8).reshape(shape) != np.frombuffer(new_red, dtype=np.uint8).reshape(shape)
+
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(changed.any(axis=0))
+    return int(cols[0]) * 8, int(rows[0]), (int(cols[-1]) - int(cols[0]) + 1) * 8, int(rows[-1]) - int(rows[0]) + 1
+
+
+def _cropBuffer(buf: bytes, x: int, y: int, w: int, h: int, width: int=EPD_WIDTH, height: int=EPD_HEIGHT) -> bytes:
+    return np.frombuffer(buf, dtype=np.uint8).reshape(height, int(width / 8))[y:y + h, int(x / 8):int((x + w) / 8)].tobytes()
 
-if os.name == 'posix':
-    from src.epd7in5b_V2 import EPD
 
 
 class ePaper():
-    def __init__(self):
+    def __init__(self, busy_poll_ms: float=None, busy_timeout: float=None, partial_refresh: bool=False, full_refresh_every: int=5, partial_max_area: float=0.5):
         self.epaper = EPD()
-        self._inited = False
+        if not busy_poll_ms is None:
+            self.epaper.busy_poll_ms = busy_poll_ms
+        if not busy_timeout is None:
+            self.epaper.busy_timeout_ms = busy_timeout * 1000.0
+        # If enabled, only the window that changed since the previous refresh
+        # is refreshed, unless it is larger than partial_max_area (a fraction
+        # of the panel). To limit ghosting, every full_refresh_every-th refresh
+        # is a full one.
+        self.partial_refresh = partial_refresh
+        self.full_refresh_every = full_refresh_every
+        self.partial_max_area = partial_max_area
+        self._num_partials = 0
+        # The panel buffers (black, red) that are currently shown, if known.
+        self._shown: tuple[bytes, bytes] = None
+        self._power = POWER_STATE.DEEP_SLEEP
+        self._last_busy = 0.0
+        self._last_full = False
         self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
-    
-    @staticmethod
-    def display(black_img: Image, red_img, clear_before: bool=False):
-        e = ePaper()
-        e._display(black_img=black_img, red_img=red_img, clear_before=clear_before, sleep_after=False)
-        # When 'e' is destructed, __del__() will make the display sleep.
-        return None
-    
+
     def __del__(self):
         try:
-            self.logger.debug('Sending e-paper display to sleep.')
-            self.epaper.sleep()
+            if self._power != POWER_STATE.DEEP_SLEEP:
+                self.sleep()
         except Exception as e:
             self.logger.warning(f'The e-paper had an exception while attempting to sleep: ' + str(e))
-    
-    def _display(self, black_img: Image, red_img: Image, clear_before: bool=False, sleep_after: bool=True, cancel_after: float=60.0):
+
+    @property
+    def powerState(self) -> POWER_STATE:
+        return self._power
+
+    @property
+    def lastBusy(self) -> float:
+        """
+        The seconds the panel was busy with the last refresh (including clearing
+        it before), as reported by its BUSY pin.
+        """
+        return self._last_busy
+
+    @property
+    def lastFull(self) -> bool:
+        """
+        Whether the last refresh was a full one (rather than a partial or a
+        skipped one).
+        """
+        return self._last_full
+
+    def wake(self):
+        if self._power == POWER_STATE.DEEP_SLEEP:
+            start = timer()
+            self.epaper.init()
+            self.logger.debug(f'Initialized e-paper display in {format(timer() - start, ".2f")} seconds.')
+        elif self._power == POWER_STATE.POWERED_OFF:
+            self.logger.debug('Powering on e-paper display.')
+            self.epaper.power_on()
+        self._power = POWER_STATE.ACTIVE
+        return self
+
+    def powerOff(self):
+        if self._power == POWER_STATE.ACTIVE:
+            self.logger.debug('Powering off e-paper display.')
+            self.epaper.power_off()
+            self._power = POWER_STATE.POWERED_OFF
+        return self
+
+    def sleep(self):
+        if self._power != POWER_STATE.DEEP_SLEEP:
+            self.powerOff()
+            self.logger.debug('Sending e-paper display to sleep.')
+            self.epaper.deep_sleep()
+            self._power = POWER_STATE.DEEP_SLEEP
+        return self
+
+    def _release(self):
+        """
+        Releases the module without talking to the panel, whose state is unknown
+        after an error. The next refresh will then reset and initialize it.
+        """
+        try:
+            self.epaper.epdconfig.module_exit()
+        except Exception as e:
+            self.logger.warning('Releasing the e-paper module incurred an exception: ' + str(e))
+        self._power = POWER_STATE.DEEP_SLEEP
+        self._shown = None
+        return self
+
+    def _partialWindow(self, black_buf, red_buf) -> Union[tuple[int, int, int, int], None]:
+        """
+        Returns the window for a partial refresh, (0, 0, 0, 0) if nothing needs
+        to be refreshed, or None if a full refresh is required.
+        """
+        if not self.partial_refresh or self._shown is None or self._num_partials >= self.full_refresh_every - 1:
+            return None
+        window = changedWindow(old_black=self._shown[0], old_red=self._shown[1], new_black=black_buf, new_red=red_buf)
+        if window is None:
+            return 0, 0, 0, 0
+        if window[2] * window[3] > self.partial_max_area * EPD_WIDTH * EPD_HEIGHT:
+            return None
+        return window
+
+    def _display(self, black_img: Image=None, red_img: Image=None, clear_before: bool=False, sleep_after: bool=True, cancel_after: float=60.0, black_buf=None, red_buf=None, full_refresh: bool=False):
         def interrupt():
             self.logger.debug('Forcefully interrupting the e-paper.')
             had_ex = False
@@ -38,52 +153,184 @@ class ePaper():
                 had_ex = True
             if not had_ex:
                 self.logger.debug('Forceful interruption of e-paper did NOT incur an immediate exception.')
-        
+
         timer: Timer = None
         if type(cancel_after) is float and cancel_after > 0:
             timer = Timer(interval=cancel_after, function=interrupt)
             timer.start()
 
         try:
-            if not self._inited:
-                self.epaper.init()
-                self._inited = True
-            
+            self.wake()
+
+            if black_buf is None or red_buf is None:
+                black_buf = self.epaper.getbuffer(black_img, invert=False)
+                red_buf = self.epaper.getbuffer(red_img)
+
+            busy = 0.0
+            window = None if clear_before or full_refresh else self._partialWindow(black_buf=black_buf, red_buf=red_buf)
             if clear_before:
                 self.logger.debug('Clearing e-paper display.')
-                self.epaper.Clear()
+                busy += self.epaper.Clear()
 
-            self.epaper.display(
-                imageblack=self.epaper.getbuffer(black_img),
-                imagered=self.epaper.getbuffer(red_img))
+            if window is None:
+                busy += self.epaper.display_buffers(imageblack=black_buf, imagered=red_buf)
+                self._num_partials = 0
+            elif window[2] == 0:
+                self.logger.debug('The e-paper already shows these planes, skipping the refresh.')
+            else:
+                x, y, w, h = window
+                self.logger.debug(f'Partially refreshing the e-paper in window {w}x{h}+{x}+{y}.')
+                busy += self.epaper.display_partial(
+                    imageblack=_cropBuffer(buf=black_buf, x=x, y=y, w=w, h=h),
+                    imagered=_cropBuffer(buf=red_buf, x=x, y=y, w=w, h=h),
+                    x=x, y=y, width=w, height=h)
+                self._num_partials += 1
+            self._shown = (bytes(black_buf), bytes(red_buf))
+            self._last_busy = busy
+            self._last_full = window is None
 
             if type(timer) is Timer and timer.is_alive():
                 timer.cancel()
 
             if sleep_after:
-                self.logger.debug('Sending e-paper display to sleep.')
-                self.epaper.sleep()
+                self.sleep()
         except Exception as e:
             self.logger.warning('Attempting to display an image on the e-paper triggered an exception: ' + str(e))
+            self._release()
             raise e # re-throw this because it must be handled up the chain!
         finally:
             if type(timer) is Timer and timer.is_alive():
                 timer.cancel()
 
-        
+
         return self
-    
+
     def calibrate(self, cycles=1):
         # Calibrates the display to prevent ghosting
         white = Image.new('1', (800, 480), 'white')
         black = Image.new('1', (800, 480), 'black')
 
         for _ in range(cycles):
-            self._display(black_img=black, red_img=white, sleep_after=False)
-            self._display(black_img=black, red_img=white, sleep_after=False)
-            self._display(black_img=white, red_img=black, sleep_after=False)
-            self._display(black_img=white, red_img=white, sleep_after=False)
+            self._display(black_img=black, red_img=white, sleep_after=False, full_refresh=True)
+            self._display(black_img=black, red_img=white, sleep_after=False, full_refresh=True)
+            self._display(black_img=white, red_img=black, sleep_after=False, full_refresh=True)
+            self._display(black_img=white, red_img=white, sleep_after=False, full_refresh=True)
 
+        # Partial refreshes must not build upon what was shown before.
+        self._shown = None
+        self._num_partials = 0
         self.logger.info(f'Calibrated e-paper display using {cycles} cycle(s).')
         return self
 
+
+
+class ePaperSession:
+    """
+    A long-lived session with the e-paper that keeps the panel initialized
+    between refreshes. After a refresh, the panel is powered off once it was
+    idle for power_off_after seconds, and sent to deep sleep once it was idle
+    for deep_sleep_after seconds. Refreshes in between therefore only need to
+    power it on again (or nothing at all), instead of a reset and a full
+    initialization. The panel itself is only obtained on first use.
+    """
+    def __init__(self, power_off_after: float=10.0, deep_sleep_after: float=180.0, cancel_after: float=60.0, busy_poll_ms: float=None, busy_timeout: float=None, partial_refresh: bool=False, full_refresh_every: int=5, partial_max_area: float=0.5):
+        self.power_off_after = power_off_after
+        self.deep_sleep_after = max(power_off_after, deep_sleep_after)
+        self.cancel_after = cancel_after
+        self.busy_poll_ms = busy_poll_ms
+        self.busy_timeout = busy_timeout
+        self.partial_refresh = partial_refresh
+        self.full_refresh_every = full_refresh_every
+        self.partial_max_area = partial_max_area
+        self._epaper: ePaper = None
+        self._semaphore = Semaphore(1)
+        self._idle_task: ScheduledTask = None
+        # Incremented with every use, such that idle transitions that were
+        # scheduled before can tell that they are outdated.
+        self._generation = 0
+        self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
+
+    @property
+    def powerState(self) -> POWER_STATE:
+        if self._epaper is None:
+            return POWER_STATE.DEEP_SLEEP
+        return self._epaper.powerState
+
+    @property
+    def lastBusy(self) -> float:
+        if self._epaper is None:
+            return 0.0
+        return self._epaper.lastBusy
+
+    @property
+    def lastFull(self) -> bool:
+        if self._epaper is None:
+            return False
+        return self._epaper.lastFull
+
+    def _unsetIdleTask(self):
+        if type(self._idle_task) is ScheduledTask and self._idle_task.pending:
+            self._idle_task.cancel()
+        return self
+
+    def _setIdleTask(self, generation: int, delay: float, fn):
+        def idle():
+            self._semaphore.acquire()
+            try:
+                if generation == self._generation and not self._epaper is None:
+                    fn()
+            except Exception as e:
+                self.logger.warning(f'Changing the power state of the e-paper incurred an exception: {str(e)}')
+                self._epaper._release()
+            finally:
+                self._semaphore.release()
+
+        self._unsetIdleTask()
+        self._idle_task = scheduler.schedule(delay=delay, fn=idle, name=f'{self.__class__.__name__}(idle)')
+        return self
+
+    def _powerOff(self, generation: int):
+        self._epaper.powerOff()
+        return self._setIdleTask(generation=generation, delay=self.deep_sleep_after - self.power_off_after, fn=lambda: self._epaper.sleep())
+
+    def _use(self, fn):
+        self._semaphore.acquire()
+        try:
+            self._unsetIdleTask()
+            self._generation += 1
+            if self._epaper is None:
+                self._epaper = ePaper(
+                    busy_poll_ms=self.busy_poll_ms, busy_timeout=self.busy_timeout, partial_refresh=self.partial_refresh,
+                    full_refresh_every=self.full_refresh_every, partial_max_area=self.partial_max_area)
+            return fn(self._epaper)
+        finally:
+            generation = self._generation
+            self._setIdleTask(generation=generation, delay=self.power_off_after, fn=lambda: self._powerOff(generation=generation))
+            self._semaphore.release()
+
+    def display(self, black_img: Image=None, red_img: Image=None, clear_before: bool=False, black_buf=None, red_buf=None):
+        """
+        Displays either the images or the panel-ready buffers (see ScreenPlanes).
+        """
+        self._use(lambda e: e._display(black_img=black_img, red_img=red_img, black_buf=black_buf, red_buf=red_buf, clear_before=clear_before, sleep_after=False, cancel_after=self.cancel_after))
+        return self
+
+    def calibrate(self, cycles=1):
+        self._use(lambda e: e.calibrate(cycles=cycles))
+        return self
+
+    def close(self):
+        """
+        Sends the panel to deep sleep right away.
+        """
+        self._semaphore.acquire()
+        try:
+            self._unsetIdleTask()
+            self._generation += 1
+            if not self._epaper is None:
+                self._epaper.sleep()
+        except Exception as e:
+            self.logger.warning(f'The e-paper had an exception while attempting to sleep: {str(e)}')
+        finally:
+            self._semaphore.release()
+        return self
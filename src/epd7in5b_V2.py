@@ -28,14 +28,9 @@
 #
 
 
-import os
 import time
 from src.CustomFormatter import CustomFormatter
-
-
-if os.name == 'posix':
-    import spidev
-    import RPi.GPIO
+from src.hardware.Backend import GPIO, SpiDev
 
 
 
@@ -45,6 +40,36 @@ if os.name == 'posix':
 EPD_WIDTH       = 800
 EPD_HEIGHT      = 480
 
+# Constant frames, so that blank buffers do not have to be built every time.
+# In the e-paper world 0=white and 1=black (or red, respectively).
+EPD_FRAME_SIZE  = int(EPD_WIDTH / 8) * EPD_HEIGHT
+FRAME_ZEROS     = bytes(EPD_FRAME_SIZE)
+FRAME_ONES      = bytes([0xFF]) * EPD_FRAME_SIZE
+
+# Inverts every bit of a byte when used with bytes.translate().
+_INVERT = bytes(range(255, -1, -1))
+
+
+def imageToBuffer(image, width=EPD_WIDTH, height=EPD_HEIGHT, invert=True):
+    """
+    Packs an image into a 1-bit buffer, rotating it if needed. Returns None if
+    the image has wrong dimensions. The bytes are inverted, because in the PIL
+    world 0=black and 1=white, but in the e-paper world 0=white and 1=black,
+    unless invert is False (the black plane is sent as it comes from PIL, see
+    EPD.display_buffers()).
+    """
+    imwidth, imheight = image.size
+    if(imwidth == width and imheight == height):
+        img = image.convert('1')
+    elif(imwidth == height and imheight == width):
+        # image has correct dimensions, but needs to be rotated
+        img = image.rotate(90, expand=True).convert('1')
+    else:
+        return None
+
+    buf = img.tobytes('raw')
+    return buf.translate(_INVERT) if invert else buf
+
 
 class RaspberryPi:
     # Pin definition
@@ -54,8 +79,9 @@ class RaspberryPi:
     BUSY_PIN = 24
 
     def __init__(self):
-        self.GPIO = RPi.GPIO
-        self.SPI = spidev.SpiDev()
+        # Either the actual RPi.GPIO and spidev, or their simulation.
+        self.GPIO = GPIO
+        self.SPI = SpiDev()
         self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
 
     def digital_write(self, pin, value):
@@ -69,6 +95,11 @@ class RaspberryPi:
     def digital_read(self, pin):
         return self.GPIO.input(pin)
 
+    def wait_for_rising_edge(self, pin, timeout_ms):
+        # Returns False if there was no edge within the timeout. Raises if edge
+        # detection is not available for the pin.
+        return self.GPIO.wait_for_edge(pin, self.GPIO.RISING, timeout=max(1, int(timeout_ms))) is not None
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -118,6 +149,13 @@ class EPD:
         self.cs_pin = self.epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        # While busy, the BUSY pin is checked at least this often (also when
+        # waiting for its edge), and at most for this long.
+        self.busy_poll_ms = 50
+        self.busy_timeout_ms = 90000
+        self._use_edge = True
+        # Seconds the panel was busy during the last ReadBusy().
+        self.last_busy = 0.0
         self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
 
     # Hardware reset
@@ -144,18 +182,48 @@ class EPD:
     def send_data2(self, data): #faster
         self.epdconfig.digital_write(self.dc_pin, 1)
         self.epdconfig.digital_write(self.cs_pin, 0)
-        self.epdconfig.SPI.writebytes2(data)
+        # writebytes2() accepts any buffer, so we do not need to copy it.
+        self.epdconfig.SPI.writebytes2(memoryview(data))
         self.epdconfig.digital_write(self.cs_pin, 1)
 
     def ReadBusy(self):
+        # BUSY is low while the panel is busy. Instead of spinning, we block on
+        # its rising edge (or sleep, if edge detection is unavailable), but no
+        # longer than busy_poll_ms at a time, so a missed edge costs little.
+        # The panel is only asked for its status (0x71) before waiting, and
+        # again once BUSY went high or the wait timed out.
         self.logger.debug("e-Paper busy")
+        start = time.monotonic()
         self.send_command(0x71)
         busy = self.epdconfig.digital_read(self.busy_pin)
         while(busy == 0):
-            self.send_command(0x71)
+            waited_ms = (time.monotonic() - start) * 1000.0
+            if waited_ms > self.busy_timeout_ms:
+                self.send_command(0x71)
+                if self.epdconfig.digital_read(self.busy_pin) == 0:
+                    raise Exception(f'e-Paper still busy after {format(waited_ms / 1000.0, ".2f")} seconds.')
+                break
+
+            timeout_ms = min(self.busy_poll_ms, self.busy_timeout_ms - waited_ms)
+            edge = False
+            if self._use_edge:
+                try:
+                    edge = self.epdconfig.wait_for_rising_edge(self.busy_pin, timeout_ms)
+                except Exception as e:
+                    self.logger.warning(f'Cannot wait for the BUSY pin\'s edge, polling it instead: {str(e)}')
+                    self._use_edge = False
+            if not self._use_edge:
+                self.epdconfig.delay_ms(timeout_ms)
+
             busy = self.epdconfig.digital_read(self.busy_pin)
+            if edge or busy != 0:
+                self.send_command(0x71)
+                busy = self.epdconfig.digital_read(self.busy_pin)
+
+        self.last_busy = time.monotonic() - start
         self.epdconfig.delay_ms(200)
-        self.logger.debug("e-Paper busy release")
+        self.logger.debug(f"e-Paper busy release after {format(self.last_busy, '.2f')} seconds")
+        return self.last_busy
         
     def init(self):
         if (self.epdconfig.module_init() != 0):
@@ -206,31 +274,23 @@ class EPD:
     
         return 0
 
-    def getbuffer(self, image):
-        img = image
-        imwidth, imheight = img.size
-        if(imwidth == self.width and imheight == self.height):
-            img = img.convert('1')
-        elif(imwidth == self.height and imheight == self.width):
-            # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
-        else:
+    def getbuffer(self, image, invert=True):
+        buf = imageToBuffer(image, width=self.width, height=self.height, invert=invert)
+        if buf is None:
             self.logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
-
-        buf = bytearray(img.tobytes('raw'))
-        # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
-        # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
+            return FRAME_ZEROS if invert else FRAME_ONES
         return buf
 
     def display(self, imageblack, imagered):
+        # The black bytes need to be inverted back from what getbuffer did. Use
+        # getbuffer(image, invert=False) and display_buffers() to avoid this.
+        return self.display_buffers(bytes(imageblack).translate(_INVERT), imagered)
+
+    def display_buffers(self, imageblack, imagered):
+        # Expects the buffers exactly as the panel needs them, i.e., the black
+        # one is not inverted, but the red one is (see ScreenPlanes).
         self.send_command(0x10)
-        # The black bytes need to be inverted back from what getbuffer did
-        for i in range(len(imageblack)):
-            imageblack[i] ^= 0xFF
         self.send_data2(imageblack)
 
         self.send_command(0x13)
@@ -238,27 +298,107 @@ class EPD:
         
         self.send_command(0x12)
         self.epdconfig.delay_ms(100)
-        self.ReadBusy()
+        return self.ReadBusy()
         
+    def display_partial(self, imageblack, imagered, x, y, width, height):
+        # Refreshes only the given window. The buffers hold just the window (in
+        # the same format as for display_buffers()), and x and width must be
+        # multiples of 8.
+        self.send_command(0x91) # PARTIAL_IN
+        self.send_command(0x90) # PARTIAL_WINDOW
+        self.send_data(x // 256)
+        self.send_data(x % 256)
+        self.send_data((x + width - 1) // 256)
+        self.send_data((x + width - 1) % 256)
+        self.send_data(y // 256)
+        self.send_data(y % 256)
+        self.send_data((y + height - 1) // 256)
+        self.send_data((y + height - 1) % 256)
+        self.send_data(0x01) # Gates scan both inside and outside of the window
+
+        self.send_command(0x10)
+        self.send_data2(imageblack)
+
+        self.send_command(0x13)
+        self.send_data2(imagered)
+
+        self.send_command(0x12)
+        self.epdconfig.delay_ms(100)
+        busy = self.ReadBusy()
+
+        self.send_command(0x92) # PARTIAL_OUT
+        return busy
+
     def Clear(self):
-        buf = [0x00] * (int(self.width/8) * self.height)
-        buf2 = [0xff] * (int(self.width/8) * self.height)
         self.send_command(0x10)
-        self.send_data2(buf2)
+        self.send_data2(FRAME_ONES)
             
         self.send_command(0x13)
-        self.send_data2(buf)
+        self.send_data2(FRAME_ZEROS)
                 
         self.send_command(0x12)
         self.epdconfig.delay_ms(100)
+        return self.ReadBusy()
+
+    def power_on(self):
+        # Only valid after power_off(); after sleep(), init() is required.
+        self.send_command(0x04) # POWER_ON
+        self.epdconfig.delay_ms(100)
         self.ReadBusy()
 
-    def sleep(self):
+    def power_off(self):
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
-        
+
+    def deep_sleep(self):
         self.send_command(0x07) # DEEP_SLEEP
         self.send_data(0XA5)
         
         self.epdconfig.delay_ms(2000)
         self.epdconfig.module_exit()
+
+    def sleep(self):
+        self.power_off()
+        self.deep_sleep()
+
+
+
+def _getbufferLoop(image):
+    """
+    The previous implementation of EPD.getbuffer(), which inverts every byte in
+    a Python loop. Only kept as reference for the benchmark below.
+    """
+    img = image.convert('1')
+    buf = bytearray(img.tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+if __name__ == "__main__":
+    # Measures the CPU time spent on buffers per refresh (with clearing before),
+    # without any hardware.
+    from timeit import default_timer as timer
+    from PIL import Image
+    import numpy as np
+
+    rng = np.random.default_rng(seed=1)
+    black = Image.fromarray(rng.integers(0, 256, size=(EPD_HEIGHT, EPD_WIDTH, 3), dtype=np.uint8), mode='RGB')
+    red = Image.fromarray(rng.integers(0, 256, size=(EPD_HEIGHT, EPD_WIDTH, 3), dtype=np.uint8), mode='RGB')
+
+    start = timer()
+    old_clear = ([0x00] * EPD_FRAME_SIZE, [0xff] * EPD_FRAME_SIZE)
+    old_black = _getbufferLoop(black)
+    old_red = _getbufferLoop(red)
+    for i in range(len(old_black)):
+        old_black[i] ^= 0xFF
+    old_time = timer() - start
+
+    start = timer()
+    new_clear = (FRAME_ZEROS, FRAME_ONES)
+    new_black = imageToBuffer(black, invert=False)
+    new_red = imageToBuffer(red)
+    new_time = timer() - start
+
+    same = bytes(old_black) == new_black and bytes(old_red) == new_red and bytes(old_clear[0]) == new_clear[0] and bytes(old_clear[1]) == new_clear[1]
+    print(f'Per refresh: loops took {format(old_time, ".3f")}s, translate took {format(new_time, ".3f")}s ({format(old_time / new_time, ".0f")}x), identical: {same}')
@@ -0,0 +1,82 @@
+import os
+from typing import TYPE_CHECKING, Any, Union
+from src.CustomFormatter import CustomFormatter
+
+if TYPE_CHECKING:
+    from src.hardware.Simulation import Simulation
+
+
+# The backend that all hardware modules use. 'rpi' is the actual Raspberry Pi
+# (RPi.GPIO, spidev, rpi_lcd), 'simulated' simulates the e-paper, text LCD and
+# GPIO (see Simulation), and 'none' means there is no hardware at all.
+_backend = 'rpi' if os.name == 'posix' else 'none'
+_simulation: 'Simulation' = None
+
+logger = CustomFormatter.getLoggerFor('Backend')
+
+
+def configure(conf: dict[str, Any], data_folder: str):
+    """
+    Selects the backend from the 'hardware' section of the general config.
+    Must happen before any hardware is used.
+    """
+    global _backend, _simulation
+    _backend = conf.get('backend', _backend)
+    if _backend == 'simulated':
+        from src.hardware.Simulation import Simulation
+        _simulation = Simulation(conf=conf.get('simulation', {}), data_folder=data_folder)
+    elif not _backend in ('rpi', 'none'):
+        raise Exception(f'Unknown hardware backend: "{_backend}".')
+    logger.info(f'Using hardware backend "{_backend}".')
+
+
+def name() -> str:
+    return _backend
+
+
+def available() -> bool:
+    return _backend != 'none'
+
+
+def simulation() -> Union['Simulation', None]:
+    return _simulation
+
+
+def gpio():
+    if _backend == 'rpi':
+        import RPi.GPIO
+        return RPi.GPIO
+    elif _backend == 'simulated':
+        return _simulation.gpio
+    raise Exception('There is no GPIO without a hardware backend.')
+
+
+def SpiDev():
+    if _backend == 'rpi':
+        import spidev
+        return spidev.SpiDev()
+    elif _backend == 'simulated':
+        return _simulation.spiDev()
+    raise Exception('There is no SPI without a hardware backend.')
+
+
+def LCD():
+    if _backend == 'rpi':
+        from rpi_lcd import LCD
+        return LCD()
+    elif _backend == 'simulated':
+        return _simulation.lcd
+    raise Exception('There is no LCD without a hardware backend.')
+
+
+
+class _GPIO:
+    """
+    Stands in for the RPi.GPIO module, but resolves the backend only when used,
+    such that modules can import it before the backend was configured.
+    """
+    def __getattr__(self, name: str):
+        return getattr(gpio(), name)
+
+
+GPIO = _GPIO()
@@ -0,0 +1,348 @@
+import numpy as np
+import pathlib
+from collections import Counter
+from os.path import abspath, join
+from threading import Condition, Semaphore
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Union
+from PIL import Image
+from src.CustomFormatter import CustomFormatter
+from src.Scheduler import scheduler
+
+
+
+class SimulatedGPIO:
+    """
+    Simulates the parts of RPi.GPIO that are used by this application. Levels
+    of input pins are driven by simulated devices (e.g., the e-paper's BUSY
+    pin), or by simulated button presses.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._levels: Dict[int, int] = {}
+        self._callbacks: Dict[int, tuple[int, Callable[[int], Any]]] = {}
+        # Levels that pins return to at some point: pin -> (when, level).
+        self._pending: Dict[int, tuple[float, int]] = {}
+        self._cond = Condition()
+        self.writes = 0
+        self.reads = 0
+        self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        with self._cond:
+            for pin in (channel if type(channel) is list else [channel]):
+                if not initial is None:
+                    self._levels[pin] = initial
+                elif not pin in self._levels:
+                    self._levels[pin] = SimulatedGPIO.HIGH if pull_up_down == SimulatedGPIO.PUD_UP else SimulatedGPIO.LOW
+
+    def output(self, channel, value):
+        with self._cond:
+            self.writes += 1
+        for pin in (channel if type(channel) is list else [channel]):
+            self.setLevel(pin=pin, level=value)
+
+    def input(self, channel) -> int:
+        with self._cond:
+            self.reads += 1
+            self._applyPending()
+            return self._levels.get(channel, SimulatedGPIO.LOW)
+
+    def cleanup(self, channel=None):
+        with self._cond:
+            for pin in (list(self._callbacks.keys()) if channel is None else (channel if type(channel) is list else [channel])):
+                self._callbacks.pop(pin, None)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self._cond:
+            self._callbacks[channel] = (edge, callback)
+
+    def remove_event_detect(self, channel):
+        with self._cond:
+            self._callbacks.pop(channel, None)
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """
+        Returns the channel, or None if there was no such edge within the
+        timeout (in milliseconds).
+        """
+        deadline = None if timeout is None else monotonic() + timeout / 1000.0
+        with self._cond:
+            self._applyPending()
+            level = self._levels.get(channel, SimulatedGPIO.LOW)
+            while True:
+                wakeups = [t for t in (deadline, self._pending.get(channel, (None, None))[0]) if not t is None]
+                self._cond.wait(timeout=None if len(wakeups) == 0 else max(0.0, min(wakeups) - monotonic()))
+                self._applyPending()
+                new_level = self._levels.get(channel, SimulatedGPIO.LOW)
+                if new_level != level and SimulatedGPIO._isEdge(edge=edge, level=new_level):
+                    return channel
+                level = new_level
+                if not deadline is None and monotonic() >= deadline:
+                    return None
+
+    @staticmethod
+    def _isEdge(edge: int, level: int) -> bool:
+        return edge == SimulatedGPIO.BOTH or (edge == SimulatedGPIO.RISING) == (level == SimulatedGPIO.HIGH)
+
+    def _applyPending(self):
+        now = monotonic()
+        for pin, (when, level) in list(self._pending.items()):
+            if when <= now:
+                del self._pending[pin]
+                self._levels[pin] = level
+
+    def pulse(self, pin: int, level: int, duration: float, then: int):
+        """
+        Drives the pin to the level for the duration, and then to the other
+        level. This does not need a thread (so it also works while shutting
+        down), but therefore does not fire callbacks for the second change.
+        """
+        self.setLevel(pin=pin, level=level)
+        with self._cond:
+            self._pending[pin] = (monotonic() + duration, then)
+        return self
+
+    def setLevel(self, pin: int, level: int):
+        callback: Callable[[int], Any] = None
+        with self._cond:
+            self._pending.pop(pin, None)
+            old_level = self._levels.get(pin, SimulatedGPIO.LOW)
+            self._levels[pin] = level
+            if old_level != level:
+                self._cond.notify_all()
+                if pin in self._callbacks and SimulatedGPIO._isEdge(edge=self._callbacks[pin][0], level=level):
+                    callback = self._callbacks[pin][1]
+
+        if not callback is None:
+            callback(pin)
+        return self
+
+    def press(self, pin: int, duration: float=0.05):
+        """
+        Simulates pressing (and releasing) a button that pulls the pin high.
+        """
+        self.logger.debug(f'Simulating a press of the button on pin {pin}.')
+        self.setLevel(pin=pin, level=SimulatedGPIO.HIGH)
+        sleep(duration)
+        self.setLevel(pin=pin, level=SimulatedGPIO.LOW)
+        return self
+
+
+
+class SimulatedPanel:
+    """
+    Simulates the SPI side of the 7.5" black/white/red e-paper. It tells commands
+    from data by the DC pin, counts commands and bytes, drives the BUSY pin low
+    for as long as the real panel would be busy, and captures every refreshed
+    frame (optionally as PNG). Partial refreshes (0x91, 0x90 and 0x92) only
+    change their window of the frame.
+    """
+    def __init__(self, gpio: SimulatedGPIO, width: int=800, height: int=480, dc_pin: int=25, busy_pin: int=24, refresh_time: float=15.0, partial_time: float=None, power_time: float=0.1, frames_folder: str=None):
+        self.gpio = gpio
+        self.width = width
+        self.height = height
+        self.dc_pin = dc_pin
+        self.busy_pin = busy_pin
+        self.refresh_time = refresh_time
+        self.partial_time = refresh_time if partial_time is None else partial_time
+        self.power_time = power_time
+        self.frames_folder = frames_folder
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.commands: Counter = Counter()
+        self.bytes_written = 0
+        self.busy_time = 0.0
+        self.frames = 0
+        self.partial_frames = 0
+        self.last_frame: Image.Image = None
+        self._command: int = None
+        self._planes: Dict[int, bytes] = {}
+        # What the panel shows: True where black, and where red, respectively.
+        self._black = np.zeros((height, width), dtype=bool)
+        self._red = np.zeros((height, width), dtype=bool)
+        # The partial window (x, y, width, height) while in partial mode.
+        self._partial: tuple[int, int, int, int] = None
+        self._semaphore = Semaphore(1)
+        self.logger = CustomFormatter.getLoggerFor(self.__class__.__name__)
+
+    def open(self, bus, device):
+        self.gpio.setLevel(pin=self.busy_pin, level=SimulatedGPIO.HIGH)
+
+    def close(self):
+        pass
+
+    def writebytes(self, data):
+        self._write(data=bytes(data))
+
+    def writebytes2(self, data):
+        self._write(data=bytes(data))
+
+    def _write(self, data: bytes):
+        self._semaphore.acquire()
+        try:
+            self.bytes_written += len(data)
+            if self.gpio.input(self.dc_pin) == SimulatedGPIO.LOW:
+                for command in data:
+                    self._onCommand(command=command)
+            elif self._command in (0x10, 0x13, 0x90):
+                self._planes[self._command] = self._planes.get(self._command, b'') + data
+        finally:
+            self._semaphore.release()
+
+    def _busyFor(self, seconds: float):
+        self.busy_time += seconds
+        self.gpio.pulse(pin=self.busy_pin, level=SimulatedGPIO.LOW, duration=seconds, then=SimulatedGPIO.HIGH)
+
+    def _onCommand(self, command: int):
+        self.commands[command] += 1
+        self._command = command
+        if command in (0x10, 0x13, 0x90):
+            self._planes[command] = b''
+        elif command == 0x91: # PARTIAL_IN
+            self._partial = (0, 0, self.width, self.height)
+            self._planes.pop(0x90, None)
+        elif command == 0x92: # PARTIAL_OUT
+            self._partial = None
+        elif command == 0x12: # DISPLAY_REFRESH
+            self._capture()
+            self._busyFor(seconds=self.refresh_time if self._partial is None else self.partial_time)
+        elif command in (0x02, 0x04): # POWER_OFF, POWER_ON
+            self._busyFor(seconds=self.power_time)
+
+    def _window(self) -> tuple[int, int, int, int]:
+        if self._partial is None:
+            return 0, 0, self.width, self.height
+        p = self._planes.get(0x90, b'')
+        if len(p) >= 8:
+            x0, x1 = p[0] * 256 + p[1], p[2] * 256 + p[3]
+            y0, y1 = p[4] * 256 + p[5], p[6] * 256 + p[7]
+            return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+        return self._partial
+
+    def _capture(self):
+        x, y, w, h = self._window()
+        size = int(w / 8) * h
+        black = np.frombuffer(self._planes.get(0x10, b'').ljust(size, b'\xff')[0:size], dtype=np.uint8)
+        red = np.frombuffer(self._planes.get(0x13, b'').ljust(size, b'\x00')[0:size], dtype=np.uint8)
+        # Black pixels are 0 in the black plane, red pixels are 1 in the red plane.
+        self._black[y:y + h, x:x + w] = np.unpackbits(black).reshape(h, w) == 0
+        self._red[y:y + h, x:x + w] = np.unpackbits(red).reshape(h, w) == 1
+
+        pixels = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        pixels[self._black] = (0, 0, 0)
+        pixels[self._red] = (255, 0, 0)
+        self.last_frame = Image.fromarray(pixels, mode='RGB')
+        self.frames += 1
+        if not self._partial is None:
+            self.partial_frames += 1
+
+        if not self.frames_folder is None:
+            file = abspath(join(self.frames_folder, f'frame_{self.frames:05d}.png'))
+            self.last_frame.save(file)
+            self.logger.debug(f'Captured frame {self.frames} to {file}.')
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            'frames': self.frames,
+            'partial_frames': self.partial_frames,
+            'bytes_written': self.bytes_written,
+            'busy_time': self.busy_time,
+            'commands': { f'0x{command:02X}': num for command, num in sorted(self.commands.items()) }
+        }
+
+
+
+class SimulatedLCD:
+    """
+    Simulates the 16x2 LCD of rpi_lcd. It keeps the current lines and counts
+    the I2C writes the real one would need: rpi_lcd sends every byte as two
+    nibbles, each of which takes three writes (data and the enable strobe).
+    """
+    WRITES_PER_BYTE = 6
+
+    def __init__(self, cols: int=16, rows: int=2):
+        self.cols = cols
+        self.rows = rows
+        self.lines: Dict[int, str] = { row: ''.ljust(cols) for row in range(1, rows + 1) }
+        self.i2c_writes = 0
+        self._semaphore = Semaphore(1)
+
+    def text(self, text: str, line: int, align: str='left'):
+        self._semaphore.acquire()
+        try:
+            # One command to set the address, then one byte per column.
+            self.i2c_writes += SimulatedLCD.WRITES_PER_BYTE * (1 + self.cols)
+            self.lines[line] = text.ljust(self.cols)[0:self.cols]
+        finally:
+            self._semaphore.release()
+
+    def clear(self):
+        self._semaphore.acquire()
+        try:
+            self.i2c_writes += SimulatedLCD.WRITES_PER_BYTE
+            self.lines = { row: ''.ljust(self.cols) for row in range(1, self.rows + 1) }
+        finally:
+            self._semaphore.release()
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            'i2c_writes': self.i2c_writes,
+            'lines': [self.lines[row] for row in range(1, self.rows + 1)]
+        }
+
+
+
+class Simulation:
+    """
+    Holds the simulated hardware, configured by the 'simulation' section of the
+    general 'hardware' config. Button presses can be scripted as a list of
+    { "at": <seconds after start>, "pin": <pin> }.
+    """
+    def __init__(self, conf: dict[str, Any], data_folder: str):
+        self.gpio = SimulatedGPIO()
+        self.lcd = SimulatedLCD()
+
+        frames_folder: Union[str, None] = None
+        if conf.get('capture_frames', True):
+            frames_folder = abspath(join(data_folder, conf.get('frames_folder', 'frames')))
+            pathlib.Path(frames_folder).mkdir(parents=True, exist_ok=True)
+        self.panel = SimulatedPanel(
+            gpio=self.gpio, frames_folder=frames_folder,
+            refresh_time=float(conf.get('refresh_time', 15.0)),
+            partial_time=float(conf.get('partial_time', conf.get('refresh_time', 15.0))),
+            power_time=float(conf.get('power_time', 0.1)))
+
+        for press in conf.get('presses', []):
+            scheduler.schedule(delay=float(press['at']), fn=lambda pin=press['pin']: self.gpio.press(pin=pin), name=f'{self.__class__.__name__}(press)')
+
+    def spiDev(self) -> SimulatedPanel:
+        return self.panel
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            'gpio': { 'writes': self.gpio.writes, 'reads': self.gpio.reads },
+            'epaper': self.panel.stats,
+            'lcd': self.lcd.stats
+        }
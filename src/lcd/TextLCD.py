@@ -1,6 +1,6 @@
-import os
 from typing import Dict
 from src.CustomFormatter import CustomFormatter
+from src.hardware import Backend
 from threading import Semaphore
 
 
@@ -12,9 +12,8 @@ class TextLCD:
     def __init__(self, cols: int=16, rows: int=2):
         self.cols = cols
         self.rows = rows
-        if os.name == 'posix':
-            from rpi_lcd import LCD
-            self._lcd = LCD()
+        if Backend.available():
+            self._lcd = Backend.LCD()
         self._last_lines: Dict[int, str] = {}
         for i in range(1, rows + 1):
             self._last_lines[i] = ''
@@ -20,7 +20,7 @@ class MyNewsImpl(NewsImpl):
         self._lazies: dict[str, SelfResetLazy[list[Any]]] = {}
 
         for key in self.conf['sources'].keys():
-            self._lazies[key] = SelfResetLazy(resource_name=f'headlines({key})', fnCreateVal=lambda key=key: self.getHeadlineItems(key), resetAfter=float(self.conf['sources'][key]['interval']))
+            self._lazies[key] = SelfResetLazy(resource_name=f'headlines({key})', fnCreateVal=lambda key=key: self.getHeadlineItems(key), resetAfter=float(self.conf['sources'][key]['interval']), staleWhileRevalidate=True)
     
     def getHeadlineItems(self, key: str):
         url: str = self.conf['sources'][key]['url']
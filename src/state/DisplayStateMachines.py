@@ -1,11 +1,11 @@
 from src.state.StateManager import StateManager
-from src.ePaper import ePaper
+from src.ePaper import ePaperSession
 from src.lcd.TextLCD import TextLCD
 from PIL import Image
 import os
 from os.path import exists
 from os.path import abspath, join
-from typing import Dict
+from typing import Dict, Union
 from src.lcd.apps.LcdApp import LcdApp
 from src.lcd.apps.Datetime import Datetime
 from src.lcd.apps.Progress import Progress
@@ -14,7 +14,9 @@ from typing import Dict
 from statistics import mean
 from timeit import default_timer as timer
 from time import sleep
-from fasteners import InterProcessLock
+from json import dump, load
+import atexit
+from src.ScreenPlanes import ScreenPlanes
 
 
 
@@ -28,10 +30,84 @@ class ePaperStateMachine(StateManager):
         # Used to synchronize state activations, as they are long-running and expensive
         self._busy = False
         self._last_durations: Dict[str, deque] = {}
+
+        # The e-paper stays initialized between refreshes that come close together.
+        session = self._stateConfig.get('session', {})
+        self._session = ePaperSession(
+            power_off_after=float(session.get('power_off_after', 10.0)),
+            deep_sleep_after=float(session.get('deep_sleep_after', 180.0)),
+            cancel_after=float(session.get('cancel_after', 60.0)),
+            busy_poll_ms=float(session.get('busy_poll_ms', 50.0)),
+            busy_timeout=float(session.get('busy_timeout', 90.0)),
+            partial_refresh=bool(session.get('partial_refresh', False)),
+            full_refresh_every=int(session.get('full_refresh_every', 5)),
+            partial_max_area=float(session.get('partial_max_area', 0.5)))
+        atexit.register(self._session.close)
+
+        # A hash of the planes currently shown on the e-paper. It is persisted,
+        # as the e-paper keeps showing them across restarts.
+        self._shown_file = ePaperStateMachine.shownFile(data_folder=self._config['general']['data_folder'][os.name])
+        self._shown_hash: Union[str, None] = None
+        try:
+            if exists(self._shown_file):
+                with open(file=self._shown_file, mode='r', encoding='utf-8') as fp:
+                    self._shown_hash = load(fp)['hash']
+        except Exception as e:
+            self.logger.warning(f'Cannot read what is shown on the e-paper: {str(e)}')
     
+    @staticmethod
+    def shownFile(data_folder: str) -> str:
+        return abspath(join(data_folder, 'epaper_shown.json'))
+
+    @staticmethod
+    def forgetShown(data_folder: str):
+        """
+        Must be called whenever something else was displayed on the e-paper.
+        """
+        shown_file = ePaperStateMachine.shownFile(data_folder=data_folder)
+        if exists(shown_file):
+            os.remove(shown_file)
+
+    def calibrate(self, cycles: int=1):
+        """
+        Calibrates the e-paper using this state machine's session, after which
+        it no longer shows any state.
+        """
+        self._session.calibrate(cycles=cycles)
+        self._shown_hash = None
+        ePaperStateMachine.forgetShown(data_folder=self._config['general']['data_folder'][os.name])
+        return self
+
+    def _setShownHash(self, shown_hash: Union[str, None]):
+        self._shown_hash = shown_hash
+        try:
+            temp_file = f'{self._shown_file}.tmp'
+            with open(file=temp_file, mode='w', encoding='utf-8') as fp:
+                dump({ 'hash': shown_hash }, fp)
+            os.replace(temp_file, self._shown_file)
+        except Exception as e:
+            self.logger.warning(f'Cannot persist what is shown on the e-paper: {str(e)}')
+        return self
+
+    def _isUnchanged(self, state_to: str, state_from: str=None, transition: str=None, **kwargs) -> bool:
+        """
+        The e-paper does not need to be refreshed if it already shows the same
+        planes as the ones rendered for the state.
+        """
+        if self._shown_hash is None:
+            return False
+
+        data_folder = self._config['general']['data_folder'][os.name]
+        planes_hash = ScreenPlanes(data_folder=data_folder).planesHash(name=self.aliasToOriginal(state=state_to))
+        return planes_hash == self._shown_hash
+
     @property
     def busy(self) -> bool:
         return self._busy
+
+    @property
+    def session(self) -> ePaperSession:
+        return self._session
     
     def aliasToOriginal(self, state: str) -> str:
         # We gotta check if 'state_to' is an alias of another state. If so,
@@ -70,24 +146,27 @@ class ePaperStateMachine(StateManager):
 
         fp_black = None
         fp_red = None
-        lock: InterProcessLock = None
-        lock_gotten = False
+        buf_black = None
+        buf_red = None
         try:
-            lock = InterProcessLock(path=abspath(join(data_folder, 'write.lock')))
-            lock_gotten = lock.acquire()
-
-            file_black = abspath(join(data_folder, f'{state_to}_b.png'))
-            file_red = abspath(join(data_folder, f'{state_to}_r.png'))
+            # The planes are published atomically, so we do not need any lock.
+            planes = ScreenPlanes(data_folder=data_folder)
+            if planes.hasBuffers(name=state_to):
+                # The packed planes can be sent to the e-paper as they are.
+                buf_black, buf_red, planes_hash = planes.openBuffers(name=state_to)
+            else:
+                planes_hash = planes.planesHash(name=state_to)
+                file_black, file_red = planes.pngPaths(name=state_to)
 
-            if not exists(file_black) or not exists(file_red):
-                self.logger.error('The images for writing to the display do not exist!')
-                return self
+                if not exists(file_black) or not exists(file_red):
+                    self.logger.error('The images for writing to the display do not exist!')
+                    return self
 
-            fp_black = open(file=file_black, mode='rb')
-            fp_red = open(file=file_red, mode='rb')
-            
-            blackimg = Image.open(fp=fp_black)
-            redimg = Image.open(fp=fp_red)
+                fp_black = open(file=file_black, mode='rb')
+                fp_red = open(file=file_red, mode='rb')
+                
+                blackimg = Image.open(fp=fp_black)
+                redimg = Image.open(fp=fp_red)
 
             # Now the following will take approx ~15-45 seconds. We will therefore
             # repeatedly trigger the progress event.
@@ -113,19 +192,30 @@ class ePaperStateMachine(StateManager):
             while retries >= 0:
                 try:
                     start_write = timer()
-                    ePaper.display(black_img=blackimg, red_img=redimg, clear_before=clear)
+                    if buf_black is None:
+                        self._session.display(black_img=blackimg, red_img=redimg, clear_before=clear)
+                    else:
+                        self._session.display(black_buf=buf_black, red_buf=buf_red, clear_before=clear)
 
                     duration = timer() - start_write
-                    self._last_durations[f'{state_to}_{clear}'].append(duration)
-                    self.logger.debug(f'Writing took {format(duration, ".2f")} seconds.')
+                    # Prefer how long the panel itself reported to be busy.
+                    busy = self._session.lastBusy
+                    if self._session.lastFull:
+                        # Partial refreshes are much quicker, and would make
+                        # the progress of the next full refresh too eager.
+                        self._last_durations[f'{state_to}_{clear}'].append(busy if busy > 0.0 else duration)
+                    self.logger.debug(f'Writing took {format(duration, ".2f")} seconds, the e-paper was busy for {format(busy, ".2f")} seconds.')
                     self._state = state_to
+                    self._setShownHash(shown_hash=planes_hash)
                     break
                 except Exception as e:
                     retries -= 1
                     if retries < 0:
-                        self.logger.error(f'ePaper::display finally errored after {self._retries + 1} attempt(s) to display an image. The exception was: {str(e)}')
+                        # What the e-paper shows now is unknown.
+                        self._setShownHash(shown_hash=None)
+                        self.logger.error(f'ePaperSession::display finally errored after {self._retries + 1} attempt(s) to display an image. The exception was: {str(e)}')
                         raise e # re-throw
-                    self.logger.debug(f'ePaper::display had an exception, trying again in {format(self._retry_delay, ".2f")} seconds ({retries+1} retries left). Exception was: {str(e)}')
+                    self.logger.debug(f'ePaperSession::display had an exception, trying again in {format(self._retry_delay, ".2f")} seconds ({retries+1} retries left). Exception was: {str(e)}')
                     sleep(self._retry_delay)
                 finally:
                     done = True
@@ -134,8 +224,10 @@ class ePaperStateMachine(StateManager):
                 fp_black.close()
             if not fp_red is None and not fp_red.closed:
                 fp_red.close()
-            if lock_gotten:
-                lock.release()
+            if not buf_black is None:
+                buf_black.close()
+            if not buf_red is None:
+                buf_red.close()
             self._busy = False
 
         # Before releasing, wait a few seconds so it won't be triggered too often.
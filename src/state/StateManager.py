@@ -1,7 +1,8 @@
-from threading import Timer, Semaphore
+from threading import Semaphore
 from abc import ABC, abstractmethod
 from events import Events
 from src.CustomFormatter import CustomFormatter
+from src.Scheduler import ScheduledTask, scheduler
 from concurrent.futures import ThreadPoolExecutor
 
 
@@ -12,7 +13,7 @@ class StateManager(ABC, Events):
         self._config = config
         self._stateConfig = stateConfig
         self._state: str = None
-        self._timer: Timer = None
+        self._timer: ScheduledTask = None
         self._semaphore = Semaphore(1)
         # Used to asynchronously fire events
         self._tpe = ThreadPoolExecutor(max_workers=1)
@@ -27,27 +28,35 @@ class StateManager(ABC, Events):
         return self._state
 
     def _unsetTimer(self):
-        if type(self._timer) is Timer and self._timer.is_alive():
+        if type(self._timer) is ScheduledTask and self._timer.pending:
             self._timer.cancel()
         return self
 
     
     def _setTimer(self, timeout: float):
         self._unsetTimer()
-        self._timer = Timer(interval=timeout, function=lambda: self.activate(transition='timer'))
-        self._timer.start()
+        self._timer = scheduler.schedule(delay=timeout, fn=lambda: self.activate(transition='timer'), name=f'{self.__class__.__name__}(timer)')
         return self
     
     def _initState(self, state_to: str, state_from: str=None, transition: str=None, **kwargs):
-        self.logger.debug(f'Firing event: beforeInit, before initializing state "{state_to}".')
-        self._tpe.submit(lambda: self.beforeInit(sm=self, state_from=state_from, state_to=state_to, transition=transition, **kwargs))
-
         self._unsetTimer()
 
-        # Now wait for the user implementation (init logic of the transition-into state):
-        self.logger.debug(f'Attempting finalization of state: "{state_to}".')
         try:
-            self._finalize(state_from=state_from, transition=transition, state_to=state_to, **kwargs)
+            try:
+                unchanged = self._isUnchanged(state_from=state_from, transition=transition, state_to=state_to, **kwargs)
+            except Exception as e:
+                self.logger.warning(f'Cannot tell if finalizing state "{state_to}" would change anything, finalizing it anyway: {str(e)}')
+                unchanged = False
+            if not unchanged:
+                self.logger.debug(f'Firing event: beforeInit, before initializing state "{state_to}".')
+                self._tpe.submit(lambda: self.beforeInit(sm=self, state_from=state_from, state_to=state_to, transition=transition, **kwargs))
+
+            # Now wait for the user implementation (init logic of the transition-into state):
+            if unchanged:
+                self.logger.debug(f'Finalizing state "{state_to}" would not change anything, skipping it.')
+            else:
+                self.logger.debug(f'Attempting finalization of state: "{state_to}".')
+                self._finalize(state_from=state_from, transition=transition, state_to=state_to, **kwargs)
             # Now if this was successful, replace the current state:
             self._state = state_to
 
@@ -69,8 +78,9 @@ class StateManager(ABC, Events):
                 self.logger.debug(f'Setting timer for transition into state "{tt["to"]}" after {format(tt_timeout, ".2f")} seconds.')
                 self._setTimer(timeout=tt_timeout)
             
-            self.logger.debug(f'Firing event: afterFinalize, after finalization of state "{state_to}".')
-            self._tpe.submit(lambda: self.afterFinalize(sm=self, state_from=state_from, state_to=state_to, transition=transition))
+            if not unchanged:
+                self.logger.debug(f'Firing event: afterFinalize, after finalization of state "{state_to}".')
+                self._tpe.submit(lambda: self.afterFinalize(sm=self, state_from=state_from, state_to=state_to, transition=transition))
         except Exception as e:
             self.logger.error(f'Exception occurred, cannot finalize state "{state_to}": {str(e)}')
             raise e # re-throw; 'finally' will still be run
@@ -129,6 +139,14 @@ class StateManager(ABC, Events):
         finally:
             self._semaphore.release()
 
+    def _isUnchanged(self, state_to: str, state_from: str=None, transition: str=None, **kwargs) -> bool:
+        """
+        May be overridden to tell that finalizing the state would not change
+        anything. The state is then still updated and its timers are set, but
+        neither _finalize() nor any events are run.
+        """
+        return False
+
     @abstractmethod
     def _finalize(self, state_to: str, state_from: str=None, transition: str=None, **kwargs):
         """
@@ -31,7 +31,7 @@ class MyWeatherImpl(WeatherImpl):
         self._lazies: dict[str, SelfResetLazy[dict[Any, Any]]] = {}
 
         for key in self.conf['locations'].keys():
-            self._lazies[key] = SelfResetLazy(resource_name=f'weather({key})', fnCreateVal=lambda key=key: self.getWeather(key), resetAfter=float(self.conf['locations'][key]['interval']))
+            self._lazies[key] = SelfResetLazy(resource_name=f'weather({key})', fnCreateVal=lambda key=key: self.getWeather(key), resetAfter=float(self.conf['locations'][key]['interval']), staleWhileRevalidate=True)
             self._lazies[key].valueFuture # Trigger creation of value, but don't wait for the Future
             # Otherwise, we'll get a lot of messages
             # self._lazies[key].logger.level = logging.WARN
@@ -20,7 +20,7 @@ class OpenMeteoWeatherImpl(WeatherImpl):
         self._lazies: dict[str, SelfResetLazy[dict[Any, Any]]] = {}
 
         for key in self.conf['locations'].keys():
-            self._lazies[key] = SelfResetLazy(resource_name=f'weather({key})', fnCreateVal=lambda key=key: self.getWeather(key), resetAfter=float(self.conf['locations'][key]['interval']))
+            self._lazies[key] = SelfResetLazy(resource_name=f'weather({key})', fnCreateVal=lambda key=key: self.getWeather(key), resetAfter=float(self.conf['locations'][key]['interval']), staleWhileRevalidate=True)
             self._lazies[key].valueFuture
         
         self.primary_loc: str = list(self.conf['locations'].keys())[0]
@@ -0,0 +1,203 @@
+import os
+import unittest
+from datetime import date, datetime, time
+from dateutil import tz
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from threading import Thread
+from src.CalendarMerger import CalendarMerger, DataEvent, OccurrenceStore
+
+
+# A weekly event, so that it always has occurrences around today.
+ICS = '\r\n'.join([
+    'BEGIN:VCALENDAR',
+    'VERSION:2.0',
+    'PRODID:test',
+    'BEGIN:VEVENT',
+    'UID:weekly',
+    'CREATED:20220101T000000Z',
+    'DTSTART:20220103T090000Z',
+    'DTEND:20220103T100000Z',
+    'RRULE:FREQ=WEEKLY',
+    'SUMMARY:Weekly',
+    'END:VEVENT',
+    'END:VCALENDAR',
+    ''])
+
+
+
+class CalendarServer(ThreadingHTTPServer):
+    """
+    Serves ICS at every path. If etag is set, it is sent with the calendar,
+    and requests that present it get a 304.
+    """
+    def __init__(self, etag: str=None):
+        self.body = ICS
+        self.etag = etag
+        self.requests: list[tuple[str, int]] = []
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if not server.etag is None and self.headers.get('If-None-Match') == server.etag:
+                    server.requests.append((self.path, 304))
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                server.requests.append((self.path, 200))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/calendar')
+                if not server.etag is None:
+                    self.send_header('ETag', server.etag)
+                self.end_headers()
+                self.wfile.write(server.body.encode('utf-8'))
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/cal'
+
+
+
+class ConditionalFetchTest(unittest.TestCase):
+    def setUp(self):
+        self.data_folder = TemporaryDirectory()
+
+    def tearDown(self):
+        self.data_folder.cleanup()
+
+    def _merger(self, server: CalendarServer) -> CalendarMerger:
+        return CalendarMerger(data_folder=self.data_folder.name, cal_config={
+            'merge': [{ 'name': 'test', 'url': server.url, 'interval': 3600 }],
+            'tasks': { 'include_indefinite': True, 'include_overdue_undone': True }})
+
+    def _refetch(self, merger: CalendarMerger):
+        # Expire the text, like the calendar's interval would.
+        merger.calendars['test'].cal_text.unsetValue()
+
+    def _assertUnchanged(self, server: CalendarServer, expected_status: int):
+        merger = self._merger(server=server)
+        cal = merger.calendars['test']
+        ical_file = os.path.join(self.data_folder.name, 'test.ical')
+
+        store = merger.occurrences
+        version = cal.parsed.version
+        self.assertGreater(len(store.overlapping(store.horizon_start, store.horizon_stop)), 0)
+        mtime = os.stat(ical_file).st_mtime_ns
+        os.utime(ical_file, ns=(mtime - 10**9, mtime - 10**9))
+
+        self._refetch(merger=merger)
+        self.assertIs(merger.occurrences, store)
+        self.assertEqual(cal.parsed.version, version)
+        self.assertEqual(os.stat(ical_file).st_mtime_ns, mtime - 10**9)
+        self.assertEqual([status for _, status in server.requests], [200, expected_status])
+
+    def test_not_modified(self):
+        server = CalendarServer(etag='"v1"')
+        try:
+            self._assertUnchanged(server=server, expected_status=304)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_same_body(self):
+        server = CalendarServer()
+        try:
+            self._assertUnchanged(server=server, expected_status=200)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_refresh_expired(self):
+        server = CalendarServer(etag='"v1"')
+        try:
+            merger = self._merger(server=server)
+            store = merger.occurrences
+            merger.occurrences
+            self.assertEqual(len(server.requests), 1)
+
+            # Age the text beyond the interval, without waiting for its timer.
+            merger.calendars['test'].cal_text._val_created -= 3600
+            self.assertTrue(merger.calendars['test'].isExpired)
+            self.assertIs(merger.occurrences, store)
+            self.assertEqual([status for _, status in server.requests], [200, 304])
+            self.assertFalse(merger.calendars['test'].isExpired)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_changed_body(self):
+        server = CalendarServer(etag='"v1"')
+        try:
+            merger = self._merger(server=server)
+            store = merger.occurrences
+            version = merger.calendars['test'].parsed.version
+
+            server.body = ICS.replace('SUMMARY:Weekly', 'SUMMARY:Changed')
+            server.etag = '"v2"'
+            self._refetch(merger=merger)
+            self.assertIsNot(merger.occurrences, store)
+            self.assertEqual(merger.calendars['test'].parsed.version, version + 1)
+            self.assertTrue(all(e.title == 'Changed' for e in merger.occurrences.overlapping(store.horizon_start, store.horizon_stop)))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+
+class OccurrenceStoreTest(unittest.TestCase):
+    TZ = tz.gettz('Europe/Berlin')
+
+    def _at(self, month: int, day: int, hour: int=0) -> datetime:
+        return datetime(2024, month, day, hour, tzinfo=self.TZ)
+
+    def _event(self, title: str, start, end) -> DataEvent:
+        return DataEvent(cal_name='test', created=None, start=start, end=end, title=title, desc='', location='', is_recurring=False, is_task=False)
+
+    def _bruteForce(self, events: list[DataEvent], start: datetime, stop: datetime) -> list[str]:
+        def aware(dt) -> datetime:
+            # All-day events are interpreted in the horizon's timezone.
+            return datetime.combine(dt, time(), tzinfo=self.TZ) if type(dt) is date else dt
+
+        found = [evt for evt in events if
+            (aware(evt.start) < stop and aware(evt.end) > start) or
+            (aware(evt.start) == aware(evt.end) and start <= aware(evt.start) < stop)]
+        return [evt.title for evt in sorted(found, key=lambda evt: aware(evt.start))]
+
+    def test_overlapping(self):
+        events = [
+            self._event(title='timed', start=self._at(3, 10, 9), end=self._at(3, 10, 10)),
+            self._event(title='zero', start=self._at(3, 10, 12), end=self._at(3, 10, 12)),
+            self._event(title='allday', start=date(2024, 3, 11), end=date(2024, 3, 12)),
+            self._event(title='multiday', start=date(2024, 3, 5), end=date(2024, 3, 20)),
+            self._event(title='early', start=self._at(2, 28, 22), end=self._at(3, 1, 2)),
+            self._event(title='late', start=self._at(3, 30, 20), end=self._at(4, 2)),
+            self._event(title='after', start=self._at(3, 10, 10), end=self._at(3, 10, 12)),
+        ]
+        store = OccurrenceStore(events=events, horizon_start=self._at(3, 1), horizon_stop=self._at(3, 31))
+
+        # Every span between any two bounds of the events, such that there are
+        # events ending exactly at the start, and starting exactly at the stop,
+        # as well as spans (partially) outside the horizon.
+        bounds = sorted(set([self._at(2, 1), self._at(2, 15), self._at(4, 10), self._at(4, 20)] + [
+            datetime.combine(dt, time(), tzinfo=self.TZ) if type(dt) is date else dt for evt in events for dt in (evt.start, evt.end)]))
+        for i, start in enumerate(bounds):
+            for stop in bounds[i + 1:]:
+                self.assertEqual(
+                    [evt.title for evt in store.overlapping(start, stop)],
+                    self._bruteForce(events=events, start=start, stop=stop), msg=f'[{start}, {stop})')
+
+        self.assertEqual([evt.title for evt in store.overlapping(self._at(3, 10, 10), self._at(3, 10, 12))], ['multiday', 'after'])
+        self.assertEqual([evt.title for evt in store.overlapping(self._at(3, 10, 12), self._at(3, 10, 13))], ['multiday', 'zero'])
+        self.assertEqual([evt.title for evt in store.overlapping(date(2024, 3, 11), date(2024, 3, 12))], ['multiday', 'allday'])
+        self.assertEqual(store.overlapping(self._at(2, 1), self._at(2, 15)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
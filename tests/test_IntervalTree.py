@@ -0,0 +1,38 @@
+import numpy as np
+import unittest
+from src.IntervalTree import IntervalTree
+
+
+
+def bruteContaining(starts: np.ndarray, ends: np.ndarray, point: float) -> list[int]:
+    return [i for i in range(len(starts)) if starts[i] < point < ends[i]]
+
+
+
+class IntervalTreeTest(unittest.TestCase):
+    def _assertContaining(self, starts, ends, points):
+        tree = IntervalTree(starts=starts, ends=ends)
+        for point in points:
+            self.assertEqual(sorted(tree.containing(point=point).tolist()), bruteContaining(starts=starts, ends=ends, point=point), msg=f'point={point}')
+
+    def test_empty(self):
+        self._assertContaining(starts=[], ends=[], points=[0.0, 1.0])
+
+    def test_edges(self):
+        # Zero-duration, touching, nested, identical and disjoint intervals.
+        starts = np.array([5.0, 0.0, 10.0, 10.0, 2.0, 2.0, 0.0, 20.0])
+        ends = np.array([5.0, 10.0, 20.0, 10.0, 8.0, 8.0, 30.0, 21.0])
+        points = [-1.0, 0.0, 2.0, 5.0, 7.5, 8.0, 10.0, 15.0, 20.0, 20.5, 21.0, 30.0, 31.0]
+        self._assertContaining(starts=starts, ends=ends, points=points)
+
+    def test_random(self):
+        rng = np.random.default_rng(seed=42)
+        for _ in range(20):
+            # Integer bounds, so that points often coincide with them.
+            starts = rng.integers(0, 100, size=200).astype(np.float64)
+            ends = starts + rng.integers(0, 30, size=200)
+            self._assertContaining(starts=starts, ends=ends, points=np.arange(-1.0, 131.0, 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
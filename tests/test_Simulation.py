@@ -0,0 +1,53 @@
+import unittest
+from tempfile import TemporaryDirectory
+from threading import Event
+from PIL import Image
+from src.hardware import Backend
+from src.ButtonsAndLeds import ButtonsAndLeds
+from src.ePaper import ePaperSession
+
+
+
+class SimulatedBackendTest(unittest.TestCase):
+    def setUp(self):
+        self._backend, self._simulation = Backend._backend, Backend._simulation
+        self.data_folder = TemporaryDirectory()
+
+    def tearDown(self):
+        Backend._backend, Backend._simulation = self._backend, self._simulation
+        self.data_folder.cleanup()
+
+    def test_refresh_and_press(self):
+        Backend.configure({ 'backend': 'simulated', 'simulation': {
+            'refresh_time': 0.05, 'power_time': 0.0, 'capture_frames': False,
+            'presses': [{ 'at': 0.5, 'pin': 5 }] }}, data_folder=self.data_folder.name)
+        self.assertEqual(Backend.name(), 'simulated')
+        sim = Backend.simulation()
+
+        pressed = Event()
+        bl = ButtonsAndLeds()
+        bl.on_button += lambda btn: pressed.set()
+        bl.addButton(pin=5, name='test', bounce_time=1.0)
+
+        session = ePaperSession(power_off_after=5.0, deep_sleep_after=10.0)
+        try:
+            white = Image.new('1', (800, 480), 'white')
+            session.display(black_img=white, red_img=white)
+            Backend.LCD().text('Hello', 1)
+            self.assertTrue(pressed.wait(timeout=5.0))
+        finally:
+            session.close()
+            bl.cleanup()
+
+        stats = sim.stats
+        self.assertEqual(stats['epaper']['frames'], 1)
+        self.assertEqual(stats['epaper']['partial_frames'], 0)
+        self.assertGreater(stats['epaper']['bytes_written'], 2 * 48000)
+        self.assertGreater(stats['gpio']['writes'], 0)
+        self.assertGreater(stats['gpio']['reads'], 0)
+        self.assertGreater(stats['lcd']['i2c_writes'], 0)
+        self.assertEqual(stats['lcd']['lines'][0].strip(), 'Hello')
+
+
+if __name__ == '__main__':
+    unittest.main()
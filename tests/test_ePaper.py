@@ -0,0 +1,91 @@
+import numpy as np
+import unittest
+from tempfile import TemporaryDirectory
+from PIL import Image, ImageDraw
+from src.hardware import Backend
+from src.ePaper import ePaperSession, changedWindow
+from src.epd7in5b_V2 import EPD_WIDTH, EPD_HEIGHT, imageToBuffer
+
+
+
+def pixels(buffers: tuple[bytes, bytes]) -> np.ndarray:
+    """
+    Returns the pixels the simulated panel shows for the buffers.
+    """
+    black = np.unpackbits(np.frombuffer(buffers[0], dtype=np.uint8)).reshape(EPD_HEIGHT, EPD_WIDTH) == 0
+    red = np.unpackbits(np.frombuffer(buffers[1], dtype=np.uint8)).reshape(EPD_HEIGHT, EPD_WIDTH) == 1
+    px = np.full((EPD_HEIGHT, EPD_WIDTH, 3), 255, dtype=np.uint8)
+    px[black] = (0, 0, 0)
+    px[red] = (255, 0, 0)
+    return px
+
+
+def planes(clock: str, box: tuple[int, int, int, int]=(10, 10, 300, 200)) -> tuple[bytes, bytes]:
+    """
+    Returns the panel buffers (black, red) of a screen that shows the clock in
+    its top right corner.
+    """
+    black = Image.new('1', (EPD_WIDTH, EPD_HEIGHT), 'white')
+    red = Image.new('1', (EPD_WIDTH, EPD_HEIGHT), 'white')
+    ImageDraw.Draw(black).rectangle(box, fill='black')
+    ImageDraw.Draw(black).text((613, 21), clock, fill='black')
+    ImageDraw.Draw(red).text((613, 41), clock, fill='black')
+    return imageToBuffer(black, EPD_WIDTH, EPD_HEIGHT, invert=False), imageToBuffer(red, EPD_WIDTH, EPD_HEIGHT, invert=True)
+
+
+
+class PartialRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self._backend, self._simulation = Backend._backend, Backend._simulation
+        self.data_folder = TemporaryDirectory()
+        Backend.configure({ 'backend': 'simulated', 'simulation': {
+            'refresh_time': 0.05, 'partial_time': 0.01, 'power_time': 0.0, 'capture_frames': False }}, data_folder=self.data_folder.name)
+        self.panel = Backend.simulation().panel
+        self.session = ePaperSession(power_off_after=5.0, deep_sleep_after=10.0, partial_refresh=True, full_refresh_every=3, partial_max_area=0.5)
+
+    def tearDown(self):
+        self.session.close()
+        Backend._backend, Backend._simulation = self._backend, self._simulation
+        self.data_folder.cleanup()
+
+    def _frame(self) -> np.ndarray:
+        return np.asarray(self.panel.last_frame)
+
+    def _display(self, buffers: tuple[bytes, bytes]) -> tuple[int, int]:
+        self.session.display(black_buf=buffers[0], red_buf=buffers[1])
+        return self.panel.frames, self.panel.partial_frames
+
+    def test_full_refresh_every(self):
+        counts = [self._display(buffers=planes(clock=clock)) for clock in ['10:00', '10:01', '10:02', '10:03', '10:04', '10:05']]
+        # Every third refresh is a full one.
+        self.assertEqual(counts, [(1, 0), (2, 1), (3, 2), (4, 2), (5, 3), (6, 4)])
+
+    def test_unchanged(self):
+        self._display(buffers=planes(clock='10:00'))
+        self.assertTrue(self.session.lastFull)
+        self.assertEqual(self._display(buffers=planes(clock='10:00')), (1, 0))
+        self.assertFalse(self.session.lastFull)
+
+    def test_window(self):
+        old, new = planes(clock='10:00'), planes(clock='10:01')
+        self._display(buffers=old)
+        before = self._frame()
+        self.assertEqual(self._display(buffers=new), (2, 1))
+        self.assertFalse(self.session.lastFull)
+        self.assertTrue((self._frame() == pixels(buffers=new)).all())
+
+        # Only the changed window was refreshed.
+        x, y, w, h = changedWindow(old_black=old[0], old_red=old[1], new_black=new[0], new_red=new[1])
+        changed = (self._frame() != before).any(axis=2)
+        self.assertTrue(changed.any())
+        self.assertFalse(changed[0:y, :].any() or changed[y + h:, :].any() or changed[:, 0:x].any() or changed[:, x + w:].any())
+
+    def test_partial_max_area(self):
+        self._display(buffers=planes(clock='10:00'))
+        # The changed window covers more than half of the panel.
+        self.assertEqual(self._display(buffers=planes(clock='10:00', box=(10, 10, 700, 400))), (2, 0))
+        self.assertTrue(self.session.lastFull)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+/**
+ * Lets a view be updated in place, instead of loading it again. Views call
+ * liveView(render) instead of $(document).ready(render), and render() appends
+ * #ready once it is done, as usual.
+ *
+ * liveUpdate(data) then assigns each of the data's properties to the view's
+ * global variable of the same name (the view's data has to be declared using
+ * 'let' for that), restores the body as it was before the first rendering,
+ * and renders again.
+ */
+const liveView = render => {
+    let pristine = null;
+
+    window.liveUpdate = async data => {
+        for (const [name, value] of Object.entries(data)) {
+            try {
+                new Function('value', `${name} = value;`)(value);
+            } catch (e) {
+                // Constants, such as the view's config, are kept.
+                console.debug(`Cannot update "${name}": ${e}`);
+            }
+        }
+
+        document.body.innerHTML = pristine;
+        await render();
+    };
+
+    $(document).ready(async () => {
+        pristine = document.body.innerHTML;
+        await render();
+    });
+};